@@ -1,11 +1,20 @@
 import os
-import requests
+import sys
+import aiohttp
 import logging
 from telegram import Update
+from telegram.error import BadRequest
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
 import asyncio
 import re
 import json
+import time
+import hashlib
+import sqlite3
+from threading import Lock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.urls import normalize_url  # noqa: E402
 
 # 设置日志记录到文件
 logging.basicConfig(
@@ -28,20 +37,137 @@ FIRECRAWL_API_KEY = os.environ["FIRECRAWL_API_KEY"]
 base_url_1 = 'https://api.chatanywhere.tech'
 base_url_2 = 'http://95.53.166.141:11434'
 
-def fetch_data_from_api(api_url):
+# 同时进行的分析任务数和排队上限，排满后新的请求直接被拒绝
+ANALYZE_WORKERS = int(os.environ.get('ANALYZE_WORKERS', 3))
+ANALYZE_QUEUE_SIZE = int(os.environ.get('ANALYZE_QUEUE_SIZE', 20))
+# 各步骤的超时时间（秒），超时后任务失败，不再无限等待
+EXTRACT_TIMEOUT = 300
+ANALYSIS_TIMEOUT = int(os.environ.get('ANALYSIS_TIMEOUT', 900))
+QUEUE_REFRESH_INTERVAL = 5  # 两轮排队位置更新之间的最小间隔（秒），避免大量编辑触发 Telegram 限流
+
+# 提取和分析结果的持久缓存；提取结果按链接保存，分析结果按正文哈希保存，各自过期
+CACHE_PATH = os.environ.get('ANALYZE_CACHE_PATH', 'analyze_news_cache.sqlite3')
+EXTRACT_CACHE_TTL = int(os.environ.get('EXTRACT_CACHE_TTL', 6 * 3600))
+ANALYSIS_CACHE_TTL = int(os.environ.get('ANALYSIS_CACHE_TTL', 7 * 24 * 3600))
+
+session = None  # 所有请求共用的 aiohttp 会话，在事件循环中按需创建
+
+def get_session():
+    global session
+    if session is None or session.closed:
+        session = aiohttp.ClientSession()
+    return session
+
+async def fetch_data_from_api(api_url):
     try:
-        response = requests.get(api_url)
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
+        async with get_session().get(api_url) as response:
+            response.raise_for_status()
+            return await response.json()
+    except aiohttp.ClientError as e:
         logger.error(f"请求失败: {e}")
         return None
 
+class AnalysisError(Exception):
+    """提取或分析失败，消息会直接展示给用户，且不写入缓存"""
+
+def content_hash(content):
+    return hashlib.sha256(json.dumps(content, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+class AnalysisCache:
+    """SQLite 持久缓存：extractions 以规范化链接为键保存正文，analyses 以正文哈希为键保存分析结果
+
+    不同链接指向同一正文时共用一份分析；正文过期重新提取后若内容未变，仍可直接使用已有分析。
+    查询都是本地的小事务，直接在事件循环中执行。
+    """
+    def __init__(self, path=CACHE_PATH):
+        self.lock = Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS extractions (
+                url TEXT PRIMARY KEY, content TEXT NOT NULL, hash TEXT NOT NULL, created REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS analyses (
+                hash TEXT PRIMARY KEY, result TEXT NOT NULL, created REAL NOT NULL);
+        """)
+        self.hits = 0
+        self.misses = 0
+
+    def query(self, sql, params):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def write(self, sql, params):
+        with self.lock, self.conn:
+            self.conn.execute(sql, params)
+
+    def get_extraction(self, key):
+        """返回未过期的 (正文, 哈希)，没有时返回 None"""
+        row = self.query('SELECT content, hash FROM extractions WHERE url = ? AND created > ?',
+                         (key, time.time() - EXTRACT_CACHE_TTL))
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def put_extraction(self, key, content):
+        digest = content_hash(content)
+        self.write('INSERT OR REPLACE INTO extractions VALUES (?, ?, ?, ?)',
+                   (key, json.dumps(content, ensure_ascii=False), digest, time.time()))
+        return digest
+
+    def get_analysis(self, digest):
+        row = self.query('SELECT result FROM analyses WHERE hash = ? AND created > ?',
+                         (digest, time.time() - ANALYSIS_CACHE_TTL))
+        return row[0] if row else None
+
+    def put_analysis(self, digest, result):
+        self.write('INSERT OR REPLACE INTO analyses VALUES (?, ?, ?)', (digest, result, time.time()))
+
+    def lookup(self, key):
+        """链接的正文和分析都还有效时直接返回分析结果"""
+        extraction = self.get_extraction(key)
+        result = self.get_analysis(extraction[1]) if extraction else None
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def prune(self):
+        """删除过期的记录"""
+        now = time.time()
+        self.write('DELETE FROM extractions WHERE created <= ?', (now - EXTRACT_CACHE_TTL,))
+        self.write('DELETE FROM analyses WHERE created <= ?', (now - ANALYSIS_CACHE_TTL,))
+
+    def close(self):
+        logger.info(f"分析缓存：命中 {self.hits} 次，未命中 {self.misses} 次")
+        with self.lock:
+            self.conn.close()
+
+cache = None
+
+def get_cache():
+    global cache
+    if cache is None:
+        cache = AnalysisCache()
+    return cache
+
+class SingleFlight:
+    """同一个键同时只执行一次，其余调用等待并共享同一个结果"""
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, factory):
+        call = self.calls.get(key)
+        if call is None:
+            call = self.calls[key] = asyncio.ensure_future(factory())
+            call.add_done_callback(lambda _: self.calls.pop(key, None))
+        # 某个等待者被取消时不影响其他等待者
+        return await asyncio.shield(call)
+
+analysis_flights = SingleFlight()  # 不同链接提取出相同正文时共用一次分析
+
 def remove_think_tags(text):
     cleaned_text = re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL)
     return cleaned_text
 
-def extract_news_content(url):
+async def extract_news_content(url):
     headers = {
         'Content-Type': 'application/json',
         'Authorization': f'Bearer {FIRECRAWL_API_KEY}'
@@ -53,10 +179,11 @@ def extract_news_content(url):
         'enableWebSearch': True
     }
 
-    response = requests.post('https://api.firecrawl.dev/v1/extract', headers=headers, data=json.dumps(data), timeout=300)
+    async with get_session().post('https://api.firecrawl.dev/v1/extract', headers=headers, data=json.dumps(data),
+                                  timeout=aiohttp.ClientTimeout(total=EXTRACT_TIMEOUT)) as response:
+        result = await response.json(content_type=None)
 
-    if response.status_code == 200:
-        result = response.json()
+    if response.status == 200:
         if result.get('success'):
             logger.info(result)
             return result['data']['json']
@@ -64,14 +191,41 @@ def extract_news_content(url):
             logger.error("提取失败: %s", result)
             return None
     else:
-        logger.error("请求失败，响应: %s", response.json())
+        logger.error("请求失败，响应: %s", result)
         return None
 
-def analyze_news(url):
-    # 提取新闻正文
-    text_data = extract_news_content(url)
-    if not text_data:
-        return "获取新闻内容失败"
+async def analyze_news(url, progress=None):
+    """提取并分析新闻，优先使用缓存；progress(text) 用于汇报当前进行到哪一步"""
+    async def report(text):
+        if progress is not None:
+            await progress(text)
+
+    cache = get_cache()
+    key = normalize_url(url)
+    extraction = cache.get_extraction(key)
+    if extraction is None:
+        # 提取新闻正文
+        await report('正在提取新闻内容…')
+        text_data = await extract_news_content(url)
+        if not text_data:
+            raise AnalysisError("获取新闻内容失败")
+        digest = cache.put_extraction(key, text_data)
+    else:
+        text_data, digest = extraction
+
+    result = cache.get_analysis(digest)
+    if result is not None:
+        return result
+
+    async def analyze():
+        result = await analyze_content(text_data)
+        cache.put_analysis(digest, result)
+        return result
+
+    await report('新闻内容已获取，正在分析，耗时较长，请耐心等待…')
+    return await analysis_flights.do(digest, analyze)
+
+async def analyze_content(text_data):
 
     # 第二步：深度分析
     prompt_analysis = f"""
@@ -108,7 +262,7 @@ def analyze_news(url):
     {text_data}
     """
 
-    analysis_response = requests.post(
+    async with get_session().post(
         f"{base_url_2}/api/chat",
         headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
         json={
@@ -118,16 +272,163 @@ def analyze_news(url):
                 {"role": "user", "content": prompt_analysis}
             ],
             "stream": False
-        }
-    )
-    logger.info(analysis_response.json())
+        },
+        timeout=aiohttp.ClientTimeout(total=ANALYSIS_TIMEOUT)
+    ) as analysis_response:
+        analysis_data = await analysis_response.json(content_type=None)
+    logger.info(analysis_data)
 
-    if analysis_response.status_code == 200:
-        analysis_data = analysis_response.json()
+    if analysis_response.status == 200:
         return remove_think_tags(analysis_data['message']['content'])
     else:
-        logger.error(f"分析模型调用失败，状态码：{analysis_response.status_code}, 响应：{analysis_response.json()}")
-        return f"分析模型调用失败，状态码：{analysis_response.status_code}"
+        logger.error(f"分析模型调用失败，状态码：{analysis_response.status}, 响应：{analysis_data}")
+        raise AnalysisError(f"分析模型调用失败，状态码：{analysis_response.status}")
+
+class AnalysisJob:
+    __slots__ = ('url', 'key', 'bot', 'chat_id', 'message_id', 'status', 'followers')
+
+    def __init__(self, url, bot, chat_id, message_id):
+        self.url = url
+        self.key = normalize_url(url)
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.status = None  # 最近一次写入加载消息的文字，避免重复编辑
+        self.followers = []  # 同一链接的后续请求，共享本任务的进度和结果
+
+    async def edit(self, text, parse_mode=None, force=False):
+        """编辑加载消息；force 为 False 时跳过与当前内容相同的编辑。status 只在编辑成功后更新"""
+        if text == self.status and not force:
+            return
+        await self.bot.edit_message_text(chat_id=self.chat_id, message_id=self.message_id, text=text, parse_mode=parse_mode)
+        self.status = text
+
+    async def notify(self, text):
+        try:
+            await self.edit(text)
+        except Exception as e:
+            logger.warning(f"更新进度失败：{str(e)}")
+
+    async def send_result(self, text):
+        try:
+            await self.edit(text, parse_mode='Markdown', force=True)
+            return
+        except BadRequest as e:
+            # 模型输出的 Markdown 不一定合法，解析失败时以纯文本发送
+            logger.warning(f"以 Markdown 发送结果失败：{str(e)}")
+        try:
+            await self.edit(text, force=True)
+        except Exception as e:
+            logger.error(f"发送结果失败：{str(e)}")
+            await self.notify(f"分析已完成，但结果发送失败：{str(e)}")
+
+    async def report(self, text):
+        """更新所有等待本任务的加载消息，失败（如消息已被删除）不影响分析本身"""
+        await asyncio.gather(*(job.notify(text) for job in [self] + self.followers))
+
+    async def deliver(self, text):
+        await asyncio.gather(*(job.send_result(text) for job in [self] + self.followers))
+
+class AnalysisQueue:
+    """有界的分析任务队列，由固定数量的后台 worker 依次取出执行
+
+    处理函数只负责入队并立即返回，提取和分析都在 worker 中完成；排队中的任务在前面的任务开始时更新自己的位置。
+    同一链接已在排队或分析中时，新请求挂到该任务上等待同一个结果，不占用队列名额。
+    """
+    def __init__(self, workers=ANALYZE_WORKERS, maxsize=ANALYZE_QUEUE_SIZE):
+        self.size = workers
+        self.queue = asyncio.Queue(maxsize)
+        self.waiting = []  # 与 queue 顺序一致，用于计算排队位置
+        self.jobs = {}  # 规范化链接 -> 排队或分析中的任务
+        self.workers = []
+        self.refresher = None  # 更新排队位置的后台任务
+        self.stale = False  # 排队位置是否有变化尚未更新
+
+    def start(self):
+        self.workers = [asyncio.ensure_future(self.work()) for _ in range(self.size)]
+
+    async def stop(self):
+        if self.refresher is not None:
+            self.refresher.cancel()
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def submit(self, job):
+        """加入队列，返回应显示在加载消息上的文字；队列已满时返回 None"""
+        leader = self.jobs.get(job.key)
+        if leader is not None:
+            leader.followers.append(job)
+            if leader in self.waiting:
+                return queued_text(self.waiting.index(leader))
+            return leader.status or '正在分析中，请耐心等待…'
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            return None
+        self.jobs[job.key] = job
+        self.waiting.append(job)
+        return queued_text(len(self.waiting) - 1)
+
+    async def work(self):
+        while True:
+            job = await self.queue.get()
+            self.waiting.remove(job)
+            try:
+                self.schedule_refresh()
+                await self.run(job)
+            finally:
+                self.jobs.pop(job.key, None)
+                self.queue.task_done()
+
+    def schedule_refresh(self):
+        """在后台更新排队位置，不阻塞 worker；间隔内的多次出队合并为一轮更新"""
+        self.stale = True
+        if self.refresher is None or self.refresher.done():
+            self.refresher = asyncio.ensure_future(self.refresh_positions())
+
+    async def refresh_positions(self):
+        while self.stale:
+            self.stale = False
+            await asyncio.sleep(QUEUE_REFRESH_INTERVAL)
+            # 逐个编辑而不是同时发出，位置未变的消息不会重复编辑
+            for job in list(self.waiting):
+                await self.refresh(job)
+
+    async def refresh(self, job):
+        """更新排队位置；执行时任务可能已被其他 worker 取走，此时不再覆盖它的进度"""
+        if job in self.waiting:
+            await job.report(queued_text(self.waiting.index(job)))
+
+    async def run(self, job):
+        started = time.perf_counter()
+        try:
+            analysis_result = await analyze_news(job.url, job.report)
+        except AnalysisError as e:
+            text = str(e)
+        except asyncio.TimeoutError:
+            logger.error(f"分析超时：{job.url}")
+            text = "分析超时，请稍后再试"
+        except Exception as e:
+            logger.error(f"发生错误：{str(e)}")
+            text = f"发生错误：{str(e)}"
+        else:
+            logger.info(f"分析完成：{job.url}，耗时 {time.perf_counter() - started:.1f} 秒，"
+                        f"同时等待的请求 {len(job.followers)} 个")
+            # 结果已写入缓存，先移出任务表，之后的请求直接读缓存，不会挂到已经开始发送结果的任务上
+            self.jobs.pop(job.key, None)
+            await job.deliver(analysis_result)
+            return
+        self.jobs.pop(job.key, None)
+        await job.report(text)
+
+def queued_text(position):
+    if position == 0:
+        return '已加入队列，即将开始分析…'
+    return f'已加入队列，前面还有 {position} 个任务，请耐心等待…'
+
+analysis_queue = AnalysisQueue()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text('欢迎使用新闻分析Bot！请发送 /analyze <新闻链接> 进行分析。')
@@ -138,17 +439,40 @@ async def analyze(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     url = context.args[0]
+    try:
+        key = normalize_url(url)
+    except ValueError as e:
+        logger.warning(f"无效的链接：{url}，{str(e)}")
+        await update.message.reply_text('链接格式无效，请检查后重新发送，例如：/analyze https://www.example.com/news')
+        return
+
+    cached = get_cache().lookup(key)
+    if cached is not None:
+        try:
+            await update.message.reply_text(cached, parse_mode='Markdown')
+        except BadRequest:
+            await update.message.reply_text(cached)
+        return
+
     loading_message = await update.message.reply_text('加载中...耗时较长，请耐心等待')
+    job = AnalysisJob(url, context.bot, loading_message.chat.id, loading_message.message_id)
 
-    try:
-        analysis_result = analyze_news(url)
-        await context.bot.edit_message_text(chat_id=loading_message.chat.id, message_id=loading_message.message_id, text=analysis_result, parse_mode='Markdown')
-    except Exception as e:
-        logger.error(f"发生错误：{str(e)}")
-        await context.bot.edit_message_text(chat_id=loading_message.chat.id, message_id=loading_message.message_id, text=f"发生错误：{str(e)}")
+    status = analysis_queue.submit(job)
+    await job.notify(status or '当前分析请求过多，请稍后再试')
+
+async def start_workers(application) -> None:
+    get_cache().prune()
+    analysis_queue.start()
+
+async def shutdown(application) -> None:
+    await analysis_queue.stop()
+    if session is not None:
+        await session.close()
+    if cache is not None:
+        cache.close()
 
 def main() -> None:
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).post_init(start_workers).post_shutdown(shutdown).build()
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("analyze", analyze))
     application.run_polling()
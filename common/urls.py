@@ -0,0 +1,29 @@
+"""各机器人共用的链接处理"""
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# 规范化链接时去掉的跟踪参数：按完整参数名匹配，另外去掉所有 utm_ 开头的参数；
+# 不按前缀匹配其他名字，以免误删 sources、reference 之类的正常参数
+TRACKING_PARAMS = frozenset({
+    'fbclid', 'gclid', 'dclid', 'msclkid', 'yclid', 'igshid', 'mc_cid', 'mc_eid',
+    'spm', 'from', 'share_token', 'share_source', 'share_medium', 'share_from', 'ref', 'ref_src', 'ref_url',
+})
+TRACKING_PREFIXES = ('utm_',)
+
+def is_tracking_param(key):
+    key = key.lower()
+    return key in TRACKING_PARAMS or key.startswith(TRACKING_PREFIXES)
+
+def normalize_url(url):
+    """去掉协议、默认端口、锚点和跟踪参数，统一大小写和参数顺序，使同一链接的不同写法得到同一个键
+
+    链接格式无效（如端口不是数字）时抛出 ValueError。
+    """
+    url = url.strip()
+    if '://' not in url:
+        url = '//' + url
+    parts = urlsplit(url)
+    netloc = parts.netloc.lower()
+    if parts.port in (80, 443) and netloc.endswith(f":{parts.port}"):
+        netloc = netloc[:-len(f":{parts.port}")]
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if not is_tracking_param(key)]
+    return urlunsplit(('', netloc, parts.path.rstrip('/'), urlencode(sorted(query)), ''))
@@ -0,0 +1,374 @@
+"""hsa_v2 离线端到端基准测试
+
+在本地启动 dailyhot、NewsAPI、Ollama 与 Telegram Bot API 的替身服务（可配置延迟、错误率和 429 限流），
+把 hsa_v2 指向这些服务后完整运行 main()，报告总耗时、各阶段耗时、请求次数与内存峰值。全程不访问外网。
+
+用法：
+    python hsa/benchmark.py                       # 使用合成数据运行一次
+    python hsa/benchmark.py --runs 2              # 连续运行两次，第二次可观察缓存效果
+    python hsa/benchmark.py --fixtures fixtures/  # 回放录制的接口响应
+    python hsa/benchmark.py --telegram-429-rate 0.1 --error-rate 0.05 --json result.json
+
+回放目录结构（文件内容为接口原始 JSON 响应）：
+    fixtures/dailyhot/<平台名>.json    例如 fixtures/dailyhot/微博.json
+    fixtures/newsapi/<source 或 category>.json    例如 fixtures/newsapi/bbc-news.json
+缺失的文件会用合成数据代替。
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+from types import SimpleNamespace
+from collections import defaultdict
+
+from aiohttp import web
+
+BOT_TOKEN = "123456:BENCHMARK"
+
+# 运行 hsa_v2 之前准备好环境变量；翻译库由替身代替，不会被导入
+os.environ.setdefault("NEWS_API_KEY", "benchmark")
+os.environ.setdefault("BOT_TOKEN", BOT_TOKEN)
+os.environ.setdefault("translators_default_region", "EN")
+os.environ.setdefault("HSA_CACHE_DIR", tempfile.mkdtemp(prefix="hsa-benchmark-"))
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import hsa_v2  # noqa: E402
+from telegram import Bot  # noqa: E402
+
+WORDS = "的一是不了人我在有他这为之大来以个中上们到说国和地也子时道出而要于就下得可你年生自会那后能对着事其里所去行过家十用发天如然作方成者多日都三小军二无同么经法当起与好看学进种将还分此心前面又定见只从现因开些长把机"
+
+class StubServices:
+    """本地替身服务：统计请求次数，并按配置注入延迟、错误和 429"""
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.requests = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.runner = None
+        self.base_url = None
+        self.message_id = 1000
+        self.update_id = 0
+        self.updates = []
+        self.update_event = asyncio.Event()
+        self.chat_ids = {}
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/api/dailyhot/', self.dailyhot)
+        app.router.add_get('/v2/top-headlines', self.newsapi)
+        app.router.add_post('/api/generate', self.ollama)
+        app.router.add_post('/bot{token}/{method}', self.telegram)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def delay(self, latency):
+        if latency > 0:
+            await asyncio.sleep(latency * self.random.uniform(0.5, 1.5))
+
+    def should_fail(self, service):
+        if self.random.random() < self.args.error_rate:
+            self.errors[service] += 1
+            return True
+        return False
+
+    def load_fixture(self, kind, name):
+        if not self.args.fixtures:
+            return None
+        path = os.path.join(self.args.fixtures, kind, f"{name}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def synthetic_title(self, rng):
+        # 约两成标题来自共享事件池，模拟同一事件在多个平台同时上榜
+        if rng.random() < 0.2:
+            return f"共享热点事件第{rng.randrange(20)}号最新进展"
+        return "".join(rng.choice(WORDS) for _ in range(rng.randint(8, 24)))
+
+    async def dailyhot(self, request):
+        self.requests['dailyhot'] += 1
+        await self.delay(self.args.dailyhot_latency)
+        if self.should_fail('dailyhot'):
+            return web.Response(status=500)
+        platform = request.query.get('title', '')
+        payload = self.load_fixture('dailyhot', platform)
+        if payload is None:
+            rng = random.Random(f"{self.args.seed}:{platform}")
+            payload = {"code": 200, "data": [{
+                "title": self.synthetic_title(rng),
+                "desc": "".join(rng.choice(WORDS) for _ in range(rng.randint(0, 80))),
+                "hot": rng.randint(1000, 5000000),
+                "url": f"https://example.com/{rng.randrange(10 ** 9)}",
+                "mobileUrl": f"https://m.example.com/{rng.randrange(10 ** 9)}",
+            } for _ in range(50)]}
+        return web.json_response(payload)
+
+    async def newsapi(self, request):
+        self.requests['newsapi'] += 1
+        await self.delay(self.args.newsapi_latency)
+        if self.should_fail('newsapi'):
+            return web.Response(status=500)
+        name = request.query.get('sources') or request.query.get('category') or ''
+        payload = self.load_fixture('newsapi', name)
+        if payload is None:
+            rng = random.Random(f"{self.args.seed}:{name}")
+            words = "market election storm team chip launch court rate deal war talks record climate oil bank vote".split()
+            payload = {"status": "ok", "articles": [{
+                "title": " ".join(rng.choice(words) for _ in range(rng.randint(6, 14))).capitalize(),
+                "description": " ".join(rng.choice(words) for _ in range(rng.randint(10, 40))),
+                "url": f"https://news.example.com/{rng.randrange(10 ** 9)}",
+            } for _ in range(20)]}
+        return web.json_response(payload)
+
+    async def ollama(self, request):
+        self.requests['ollama'] += 1
+        body = await request.json()
+        prompt = body.get('prompt', '')
+        lines = [line for line in prompt.splitlines() if line[:1].isdigit()]
+        await self.delay(self.args.ollama_latency + self.args.ollama_item_latency * max(len(lines), 1))
+        if self.should_fail('ollama'):
+            return web.Response(status=500)
+
+        def pick(text):
+            return hsa_v2.CATEGORY_NAMES[sum(map(ord, text)) % len(hsa_v2.CATEGORY_NAMES)]
+
+        if '"categories"' in prompt:
+            result = {"categories": [{"id": int(line.split('.', 1)[0]), "category": pick(line)} for line in lines]}
+        else:
+            result = {"category": pick(prompt)}
+        return web.json_response({"response": json.dumps(result, ensure_ascii=False)})
+
+    def chat(self, chat_id):
+        """把频道用户名映射为固定的数字 ID"""
+        if str(chat_id).lstrip('-').isdigit():
+            return int(chat_id)
+        if chat_id not in self.chat_ids:
+            self.chat_ids[chat_id] = -1001000000000 - len(self.chat_ids)
+        return self.chat_ids[chat_id]
+
+    def next_message(self, chat_id, text):
+        self.message_id += 1
+        return {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": self.chat(chat_id), "type": "channel", "title": str(chat_id)},
+            "text": text,
+        }
+
+    async def forward_later(self, channel_message):
+        """模拟频道消息延迟一段时间后自动转发到关联群组"""
+        await self.delay(self.args.forward_delay)
+        self.update_id += 1
+        forward = self.next_message(hsa_v2.TELEGRAM_GROUP_ID, channel_message['text'])
+        forward['chat']['type'] = 'supergroup'
+        forward['is_automatic_forward'] = True
+        forward['forward_origin'] = {
+            "type": "channel", "chat": channel_message['chat'],
+            "message_id": channel_message['message_id'], "date": channel_message['date'],
+        }
+        self.updates.append({"update_id": self.update_id, "message": forward})
+        self.update_event.set()
+
+    async def telegram(self, request):
+        method = request.match_info['method']
+        self.requests[f"telegram.{method}"] += 1
+        params = dict(await request.post())
+
+        if method == 'getUpdates':
+            offset = int(params.get('offset') or 0)
+            timeout = float(params.get('timeout') or 0)
+            pending = [update for update in self.updates if update['update_id'] >= offset]
+            if not pending and timeout:
+                self.update_event.clear()
+                try:
+                    await asyncio.wait_for(self.update_event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                pending = [update for update in self.updates if update['update_id'] >= offset]
+            return web.json_response({"ok": True, "result": pending})
+
+        await self.delay(self.args.telegram_latency)
+        if self.random.random() < self.args.telegram_429_rate:
+            self.errors['telegram.429'] += 1
+            retry_after = self.args.retry_after
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {retry_after}",
+                "parameters": {"retry_after": retry_after},
+            }, status=429)
+
+        if method == 'sendMessage':
+            message = self.next_message(params.get('chat_id'), params.get('text', ''))
+            if params.get('chat_id') == hsa_v2.TELEGRAM_CHANNEL_ID:
+                asyncio.ensure_future(self.forward_later(message))
+            return web.json_response({"ok": True, "result": message})
+        if method == 'getMe':
+            return web.json_response({"ok": True, "result": {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}})
+        return web.json_response({"ok": True, "result": True})
+
+class StageTimer:
+    """包装 hsa_v2 中各阶段的函数，累计调用次数、耗时与阶段起止时间"""
+    def __init__(self):
+        self.stats = defaultdict(lambda: {'calls': 0, 'busy': 0.0, 'first': None, 'last': None})
+
+    def wrap(self, owner, name, stage):
+        original = getattr(owner, name)
+        stats = self.stats[stage]
+
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            stats['first'] = start if stats['first'] is None else min(stats['first'], start)
+            try:
+                return await original(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                stats['calls'] += 1
+                stats['busy'] += end - start
+                stats['last'] = end if stats['last'] is None else max(stats['last'], end)
+
+        setattr(owner, name, timed)
+
+    def reset(self):
+        for stats in self.stats.values():
+            stats.update(calls=0, busy=0.0, first=None, last=None)
+
+    def report(self):
+        return {stage: {
+            'calls': stats['calls'],
+            'busy_seconds': round(stats['busy'], 3),
+            'span_seconds': round(stats['last'] - stats['first'], 3) if stats['first'] is not None else 0,
+        } for stage, stats in self.stats.items()}
+
+def fake_translate(args, counter):
+    """替代 translators 的阻塞翻译函数，按文本长度模拟延迟"""
+    rng = random.Random(args.seed)
+
+    def translate_text(text, **kwargs):
+        counter['translator'] += 1
+        time.sleep(args.translate_latency * rng.uniform(0.5, 1.5) + len(text) / 20000)
+        if rng.random() < args.error_rate:
+            counter['translator.error'] += 1
+            raise RuntimeError("stub translator error")
+        return f"译{text}"
+
+    return translate_text
+
+def point_module_at(stubs, args):
+    """把 hsa_v2 的接口地址与 Telegram 客户端指向本地替身服务"""
+    hsa_v2.API_BASE_URL = f"{stubs.base_url}/api/dailyhot/"
+    hsa_v2.NEWS_API_URL = f"{stubs.base_url}/v2/top-headlines"
+    hsa_v2.OLLAMA_API_URL = f"{stubs.base_url}/api/generate"
+    bot = Bot(token=BOT_TOKEN, base_url=f"{stubs.base_url}/bot")
+    hsa_v2.bot = bot
+    if args.no_rate_limits:
+        hsa_v2.TELEGRAM_GROUP_RATE = 6000
+        hsa_v2.TELEGRAM_GROUP_BURST = 1000
+
+async def run_benchmark(args):
+    stubs = StubServices(args)
+    await stubs.start()
+    counter = defaultdict(int)
+    hsa_v2.ts = SimpleNamespace(translate_text=fake_translate(args, counter))
+    point_module_at(stubs, args)
+
+    timer = StageTimer()
+    timer.wrap(hsa_v2, 'get_data', 'fetch')
+    timer.wrap(hsa_v2, 'translate_items', 'translate')
+    timer.wrap(hsa_v2, 'classify_many', 'classify')
+    timer.wrap(hsa_v2, 'process_articles', 'cluster+classify+category')
+    timer.wrap(hsa_v2.TelegramSender, 'call', 'send')
+
+    results = []
+    try:
+        for run in range(1, args.runs + 1):
+            stubs.requests.clear()
+            stubs.errors.clear()
+            counter.clear()
+            timer.reset()
+            hsa_v2.metrics.reset()
+            tracemalloc.start()
+            start = time.perf_counter()
+            error = None
+            try:
+                await hsa_v2.main()
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            hsa_v2.close_caches()
+
+            results.append({
+                'run': run,
+                'wall_seconds': round(elapsed, 3),
+                'peak_memory_mb': round(peak / 1024 / 1024, 2),
+                'error': error,
+                'stages': timer.report(),
+                'metrics': hsa_v2.metrics.summary(),
+                'requests': dict(stubs.requests, **counter),
+                'injected_errors': dict(stubs.errors),
+            })
+    finally:
+        await stubs.stop()
+    return results
+
+def print_report(results):
+    for result in results:
+        print(f"\n=== 第 {result['run']} 次运行 ===")
+        print(f"总耗时：{result['wall_seconds']} 秒，内存峰值：{result['peak_memory_mb']} MB")
+        if result['error']:
+            print(f"运行出错：{result['error']}")
+        print(f"{'阶段':<28}{'调用':>8}{'累计耗时(s)':>14}{'跨度(s)':>10}")
+        for stage, stats in result['stages'].items():
+            print(f"{stage:<28}{stats['calls']:>8}{stats['busy_seconds']:>14}{stats['span_seconds']:>10}")
+        print(f"{'单次调用':<28}{'调用':>8}{'错误':>6}{'重试':>6}{'平均(s)':>10}{'p95≤(s)':>10}")
+        for stage, stats in result['metrics']['stages'].items():
+            print(f"{stage:<28}{stats['calls']:>8}{stats['errors']:>6}{stats['retries']:>6}{str(stats['mean']):>10}{str(stats['p95_le']):>10}")
+        print("请求次数：" + "，".join(f"{name} {count}" for name, count in sorted(result['requests'].items())))
+        if result['injected_errors']:
+            print("注入错误：" + "，".join(f"{name} {count}" for name, count in sorted(result['injected_errors'].items())))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="hsa_v2 离线端到端基准测试")
+    parser.add_argument('--runs', type=int, default=1, help="连续运行次数（共享缓存目录）")
+    parser.add_argument('--seed', type=int, default=42, help="随机种子，保证结果可复现")
+    parser.add_argument('--fixtures', help="回放的接口响应目录")
+    parser.add_argument('--json', help="把结果写入指定的 JSON 文件")
+    parser.add_argument('--dailyhot-latency', type=float, default=0.3, help="dailyhot 接口延迟（秒）")
+    parser.add_argument('--newsapi-latency', type=float, default=0.4, help="NewsAPI 接口延迟（秒）")
+    parser.add_argument('--ollama-latency', type=float, default=2.0, help="Ollama 每次请求的基础延迟（秒）")
+    parser.add_argument('--ollama-item-latency', type=float, default=0.2, help="Ollama 每条新闻增加的延迟（秒）")
+    parser.add_argument('--translate-latency', type=float, default=0.8, help="翻译请求延迟（秒）")
+    parser.add_argument('--telegram-latency', type=float, default=0.1, help="Telegram 接口延迟（秒）")
+    parser.add_argument('--forward-delay', type=float, default=1.0, help="频道消息自动转发到群组的延迟（秒）")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="dailyhot/NewsAPI/Ollama/翻译的错误率")
+    parser.add_argument('--telegram-429-rate', type=float, default=0.0, help="Telegram 返回 429 的概率")
+    parser.add_argument('--retry-after', type=int, default=1, help="429 响应中的 retry_after（秒）")
+    parser.add_argument('--no-rate-limits', action='store_true', help="放开 hsa_v2 的群组限速，只测量其他阶段")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    print(f"缓存目录：{os.environ['HSA_CACHE_DIR']}")
+    print(f"hsa_v2 模块加载：{hsa_v2.MODULE_LOADED - hsa_v2.MODULE_STARTED:.2f} 秒")
+    results = asyncio.run(run_benchmark(args))
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
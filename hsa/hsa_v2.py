@@ -1,18 +1,75 @@
+import time
+MODULE_STARTED = time.perf_counter()  # 模块开始加载的时间，用于统计冷启动耗时
 import os
+import sys
 import asyncio
 import aiohttp
 from datetime import datetime
 import pytz
 from telegram import Bot
-import translators as ts
+from telegram.error import BadRequest, NetworkError, RetryAfter
 import re
+import html
+import json
+import math
+import random
+import importlib
+import threading
+import hashlib
+import sqlite3
+import zlib
 from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.urls import normalize_url  # noqa: E402
 
 API_BASE_URL = "https://api.pearktrue.cn/api/dailyhot/"
 NEWS_API_URL = "https://newsapi.org/v2/top-headlines"
-NEWS_API_KEY = os.environ["NEWS_API_KEY"]
 OLLAMA_API_URL = "http://61.189.189.2:11434/api/generate"
 Model = "qwq:latest"
+CLASSIFY_BATCH_SIZE = 15  # 单次分类请求包含的新闻条数
+CLASSIFY_CONCURRENCY = 2  # 同时进行的分类请求数
+CLASSIFY_BATCH_TIMEOUT = 180  # 批量分类请求的超时时间（秒）
+LOCAL_CLASSIFIER_THRESHOLD = float(os.environ.get("LOCAL_CLASSIFIER_THRESHOLD", 0.9))  # 本地分类器直接作答的置信度阈值
+LOCAL_CLASSIFIER_MIN_SAMPLES = 300  # 本地分类器开始作答前需要的 LLM 标注样本数
+LOCAL_CLASSIFIER_AUDIT_RATE = 0.1  # 高置信度条目仍抽样交给 LLM 复核的比例，用于统计准确率
+LOCAL_CLASSIFIER_MAX_VOCAB = 50000  # 本地分类器词表上限，超出时淘汰低频特征
+
+SEEN_MAX_AGE = 3 * 24 * 3600  # 已发布条目记录的保留时间（秒），超过后视为新条目
+RISING_RANKS = 5  # 排名较上次上升至少这么多位时视为上升条目，重新推送到分类频道
+
+CLUSTER_SHINGLE_SIZE = 2  # 标题聚类使用的字符 n-gram 长度
+CLUSTER_BANDS = 16  # MinHash LSH 的分段数
+CLUSTER_ROWS = 2  # 每段包含的哈希数，签名长度为 CLUSTER_BANDS * CLUSTER_ROWS
+CLUSTER_THRESHOLD = 0.6  # 判定为同一事件的 n-gram Jaccard 相似度阈值
+CLUSTER_SHORT_SHINGLES = 30  # 较短的标题 n-gram 少于这个数时按包含关系判断，而不是 Jaccard 相似度
+CLUSTER_SHORT_MAX_MISSING = 1  # 短标题最多允许有几个 n-gram 不出现在另一个标题中（插入一个词只影响一个，替换一个词至少两个）
+
+CACHE_DIR = os.environ.get("HSA_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))  # 跨运行保存的缓存目录（由 Actions cache 保存）
+
+PIPELINE_QUEUE_SIZE = 4  # 流水线各阶段之间队列的容量，下游处理不过来时上游等待
+TRANSLATE_STAGE_WORKERS = 3  # 同时翻译的数据源数
+RENDER_STAGE_WORKERS = 1  # 渲染榜单消息的协程数
+
+FETCH_DEADLINE = 60  # 抓取阶段的全局截止时间（秒），超时未返回的数据源将被丢弃
+HOST_CONCURRENCY = 4  # 对同一域名的最大并发请求数
+RESPONSE_FRESHNESS = int(os.environ.get("RESPONSE_FRESHNESS", 0))  # 新鲜度窗口（秒），窗口内直接复用上次的响应，手动重跑时可调大
+RESPONSE_CACHE_MAX_AGE = 2 * 24 * 3600  # 响应缓存的保留时间（秒）
+
+METRICS_DIR = os.environ.get("HSA_METRICS_DIR", CACHE_DIR)  # 运行指标（metrics.json / metrics.prom）的输出目录
+METRICS_HISTORY_SIZE = 500  # 跨运行保留的指标摘要条数，用于对比各次运行
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)  # 耗时直方图的分桶上界（秒）
+LOG_SAMPLE_RATE = float(os.environ.get("HSA_LOG_SAMPLE_RATE", 0.1))  # 结构化日志的抽样比例
+
+TRANSLATOR = 'caiyun'
+TRANSLATE_WORKERS = 2  # 翻译线程池大小
+TRANSLATE_BATCH_CHARS = 2000  # 单次批量翻译请求的最大字符数
+TRANSLATE_DELIMITER = "\n###\n"  # 批量翻译时文本之间的分隔符
+TRANSLATION_CACHE_SIZE = 20000  # 翻译缓存的最大条目数，超出后按最近最少使用淘汰
+TRANSLATION_CACHE_TTL = 7 * 24 * 3600  # 翻译缓存的有效期（秒）
 
 PLATFROMS = [
     ["哔哩哔哩", "mobileUrl"], ["微博", "url"],
@@ -42,34 +99,330 @@ CATEGORY_CHANNELS = {
     "其他": "@general_news_aggregation",
 }
 
+CATEGORY_NAMES = ["科技", "财经", "国际", "社会", "体育", "娱乐", "健康", "教育", "军事", "其他"]
+
 """ 因tg免费用户公开频道上限，暂时不使用的分类：
     "健康": "@health_news_aggregation",
     "教育": "@education_news_aggregation",
 """
 
-TELEGRAM_BOT_TOKEN = os.environ["BOT_TOKEN"]
 TELEGRAM_CHANNEL_ID = '@hot_spot_aggregation' # -1002536090782
 TELEGRAM_GROUP_ID = '-1002699038758'
 
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
-# _ = ts.preaccelerate_and_speedtest()
+TELEGRAM_GLOBAL_RATE = 30  # 全局每秒最多发送的消息数
+TELEGRAM_CHAT_RATE = 1  # 单个私聊每秒最多发送的消息数
+TELEGRAM_GROUP_RATE = 20  # 单个群组/频道每分钟最多发送的消息数
+TELEGRAM_GROUP_BURST = 5  # 单个群组/频道允许的突发消息数
+TELEGRAM_MAX_RETRIES = 5  # 单条消息的最大重试次数
+FORWARD_TIMEOUT = 30  # 等待频道消息自动转发到关联群组的最长时间（秒）
+FORWARD_POLL_TIMEOUT = 10  # 后台 get_updates 长轮询的超时时间（秒）
+TELEGRAM_MESSAGE_LIMIT = 4096  # 单条消息去掉 HTML 标签后的最大长度（UTF-16 码元）
+MESSAGE_MAX_ITEMS = int(os.environ.get("HSA_MESSAGE_MAX_ITEMS", 30))  # 单条消息最多包含的条目数
+RANKING_SIZE = 10  # 主频道榜单消息展示的条目数，其余条目以评论形式发送
+
+PREWARM = os.environ.get("HSA_PREWARM", "1") != "0"  # 是否在首轮抓取期间于后台线程预先导入较重的模块
+
+bot = None  # 首次发送时才创建，见 get_bot()
+ts = None  # translators 模块，导入较慢，首次翻译时才导入，见 get_translators()
+import_profile = {}  # 模块名 -> 延迟导入耗时（秒）
+
+host_semaphores = {}  # 域名 -> asyncio.Semaphore，限制对同一服务的并发
+classify_semaphore = None  # 限制同时进行的分类请求数
+
+def lazy_import(name):
+    """首次使用时才导入模块，并记录导入耗时
+
+    总是经过 importlib：预热线程正在导入同一模块时会等待其导入完成，而不是从 sys.modules 取到尚未初始化完的模块。
+    """
+    imported = name in sys.modules
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    if not imported:
+        import_profile.setdefault(name, time.perf_counter() - start)
+        metrics.observe('import', import_profile[name])
+    return module
+
+def get_translators():
+    global ts
+    if ts is None:
+        ts = lazy_import('translators')
+        # _ = ts.preaccelerate_and_speedtest()
+    return ts
+
+def get_bot():
+    global bot
+    if bot is None:
+        bot = Bot(token=os.environ["BOT_TOKEN"])
+    return bot
+
+def prewarm():
+    """在后台线程中预先导入翻译库，与首轮网络抓取重叠进行"""
+    def warm():
+        try:
+            get_translators()
+        except Exception as e:
+            print(f"预热导入失败：{str(e)}")
+
+    if PREWARM:
+        threading.Thread(target=warm, name="prewarm", daemon=True).start()
+
+def report_startup():
+    """打印冷启动耗时：模块加载时间以及各延迟导入的耗时"""
+    print(f"冷启动：模块加载 {MODULE_LOADED - MODULE_STARTED:.2f} 秒")
+    for name, seconds in sorted(import_profile.items(), key=lambda entry: -entry[1]):
+        print(f"  延迟导入 {name}：{seconds:.2f} 秒")
+
+class Metrics:
+    """单次运行的指标：各阶段每次调用的耗时直方图、调用数、错误数、重试数以及外部服务调用总数
+
+    运行结束时输出 JSON 摘要和 Prometheus textfile 格式的指标文件，并把摘要追加到历史记录中。
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.latencies = defaultdict(lambda: [0] * (len(self.buckets) + 1))  # 阶段 -> 各分桶计数（最后一个为 +Inf）
+        self.durations = defaultdict(float)  # 阶段 -> 累计耗时
+        self.calls = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.retries = defaultdict(int)
+        self.totals = defaultdict(int)  # 外部服务调用次数，如 llm_calls、translator_calls
+
+    def observe(self, stage, seconds):
+        self.calls[stage] += 1
+        self.durations[stage] += seconds
+        counts = self.latencies[stage]
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                counts[index] += 1
+                break
+        else:
+            counts[-1] += 1
+
+    @contextmanager
+    def span(self, stage):
+        """记录一次调用的耗时，抛出异常时计入错误数；可以包住 await"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.errors[stage] += 1
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def error(self, stage, count=1):
+        self.errors[stage] += count
+
+    def retry(self, stage, count=1):
+        self.retries[stage] += count
+
+    def count(self, name, count=1):
+        self.totals[name] += count
+
+    def quantile(self, stage, q):
+        """由直方图估算分位数，返回所在分桶的上界"""
+        if stage not in self.latencies:
+            return None
+        target = q * self.calls[stage]
+        seen = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.latencies[stage]):
+            seen += count
+            if seen >= target and count:
+                return bound
+        return None
+
+    def summary(self):
+        stages = {}
+        for stage in sorted(set(self.calls) | set(self.errors) | set(self.retries)):
+            p95 = self.quantile(stage, 0.95)
+            stages[stage] = {
+                'calls': self.calls[stage],
+                'errors': self.errors[stage],
+                'retries': self.retries[stage],
+                'seconds': round(self.durations[stage], 3),
+                'mean': round(self.durations[stage] / self.calls[stage], 3) if self.calls[stage] else None,
+                'p95_le': None if p95 is None or math.isinf(p95) else p95,
+            }
+        return {
+            'started': int(self.started),
+            'elapsed': round(time.time() - self.started, 3),
+            'stages': stages,
+            'totals': dict(self.totals),
+        }
+
+    def to_prometheus(self):
+        lines = [
+            "# HELP hsa_stage_duration_seconds Per-call latency of each pipeline stage.",
+            "# TYPE hsa_stage_duration_seconds histogram",
+        ]
+        for stage in sorted(self.latencies):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), self.latencies[stage]):
+                cumulative += count
+                le = "+Inf" if math.isinf(bound) else repr(float(bound))
+                lines.append(f'hsa_stage_duration_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'hsa_stage_duration_seconds_sum{{stage="{stage}"}} {self.durations[stage]:.6f}')
+            lines.append(f'hsa_stage_duration_seconds_count{{stage="{stage}"}} {self.calls[stage]}')
+        for name, values in (('errors', self.errors), ('retries', self.retries)):
+            lines.append(f"# TYPE hsa_stage_{name}_total counter")
+            for stage in sorted(values):
+                lines.append(f'hsa_stage_{name}_total{{stage="{stage}"}} {values[stage]}')
+        for name in sorted(self.totals):
+            lines.append(f"# TYPE hsa_{name}_total counter")
+            lines.append(f"hsa_{name}_total {self.totals[name]}")
+        lines.append("# TYPE hsa_run_duration_seconds gauge")
+        lines.append(f"hsa_run_duration_seconds {time.time() - self.started:.3f}")
+        lines.append("# TYPE hsa_run_timestamp_seconds gauge")
+        lines.append(f"hsa_run_timestamp_seconds {int(self.started)}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, directory=METRICS_DIR):
+        """写入 metrics.json、metrics.prom，并把摘要追加到 metrics_history.jsonl"""
+        summary = self.summary()
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, "metrics.json"), "w", encoding="utf-8") as file:
+                json.dump(summary, file, ensure_ascii=False, indent=2)
+            with open(os.path.join(directory, "metrics.prom"), "w", encoding="utf-8") as file:
+                file.write(self.to_prometheus())
+
+            history_path = os.path.join(directory, "metrics_history.jsonl")
+            history = []
+            if os.path.exists(history_path):
+                with open(history_path, encoding="utf-8") as file:
+                    history = file.read().splitlines()
+            history.append(json.dumps(summary, ensure_ascii=False))
+            with open(history_path, "w", encoding="utf-8") as file:
+                file.write("\n".join(history[-METRICS_HISTORY_SIZE:]) + "\n")
+        except OSError as e:
+            print(f"运行指标写入失败：{str(e)}")
+
+        print(f"运行指标：总耗时 {summary['elapsed']:.1f} 秒")
+        for stage, stats in sorted(summary['stages'].items(), key=lambda entry: -entry[1]['seconds']):
+            print(f"  {stage}：{stats['calls']} 次，累计 {stats['seconds']:.1f} 秒，错误 {stats['errors']} 次，重试 {stats['retries']} 次")
+        if summary['totals']:
+            print("  " + "，".join(f"{name} {count}" for name, count in sorted(summary['totals'].items())))
+
+metrics = Metrics()
+
+def log_sample(event, **fields):
+    """按 LOG_SAMPLE_RATE 抽样输出一行 JSON 格式的结构化日志"""
+    if random.random() < LOG_SAMPLE_RATE:
+        print(json.dumps({'event': event, **fields}, ensure_ascii=False))
 
 def escape_html(text):
     if text is None:
         return ""
     return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
 
-async def fetch_data(url, params):
-    """异步获取数据"""
-    async with aiohttp.ClientSession() as session:
+def get_host_semaphore(url):
+    """获取指定 URL 所属域名的并发信号量"""
+    host = urlparse(url).netloc
+    if host not in host_semaphores:
+        host_semaphores[host] = asyncio.Semaphore(HOST_CONCURRENCY)
+    return host_semaphores[host]
+
+class ResponseCache:
+    """接口响应缓存：按 URL 与参数（不含密钥）保存 ETag、Last-Modified、响应哈希和解析后的数据"""
+    def __init__(self, path, freshness=RESPONSE_FRESHNESS, max_age=RESPONSE_CACHE_MAX_AGE):
+        self.path = path
+        self.freshness = freshness
+        self.max_age = max_age
+        self.entries = {}
+        self.stats = defaultdict(int)
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
         try:
-            async with session.get(url, params=params, timeout=10) as response:
-                response.raise_for_status()
-                data = await response.json()
-                return data
-        except Exception as e:
-            print(f"错误：请求时发生异常：{str(e)}")
-            return None
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"响应缓存加载失败：{str(e)}")
+
+    @staticmethod
+    def make_key(url, params):
+        public = sorted((key, str(value)) for key, value in params.items() if key.lower() != 'apikey')
+        return hashlib.sha1(f"{url}?{json.dumps(public, ensure_ascii=False)}".encode('utf-8')).hexdigest()
+
+    def is_fresh(self, entry):
+        return entry is not None and time.time() - entry['fetched'] <= self.freshness
+
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def touch(self, key):
+        self.entries[key]['fetched'] = time.time()
+
+    def store(self, key, headers, body_hash, data):
+        self.entries[key] = {
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'hash': body_hash,
+            'fetched': time.time(),
+            'data': data,
+        }
+
+    def close(self):
+        now = time.time()
+        self.entries = {key: entry for key, entry in self.entries.items() if now - entry['fetched'] <= self.max_age}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False, separators=(',', ':'))
+        if self.stats:
+            print("响应缓存：" + "，".join(f"{name} {count} 次" for name, count in self.stats.items()))
+
+response_cache = ResponseCache(os.path.join(CACHE_DIR, "responses.json"))
+
+async def fetch_data(url, params):
+    """异步获取数据，失败时返回 None
+
+    新鲜度窗口内直接复用缓存；否则带上 ETag/Last-Modified 发送条件请求，
+    服务器返回 304 或响应内容哈希未变时复用缓存中已解析的数据。
+    """
+    key = response_cache.make_key(url, params)
+    entry = response_cache.entries.get(key)
+    if response_cache.is_fresh(entry):
+        response_cache.stats['新鲜度窗口命中'] += 1
+        return entry['data']
+
+    async with get_host_semaphore(url):
+        async with aiohttp.ClientSession() as session:
+            try:
+                headers = response_cache.conditional_headers(entry)
+                with metrics.span('fetch'):
+                    async with session.get(url, params=params, headers=headers, timeout=10) as response:
+                        if response.status == 304 and entry is not None:
+                            response_cache.stats['未修改(304)'] += 1
+                            response_cache.touch(key)
+                            return entry['data']
+                        response.raise_for_status()
+                        body = await response.read()
+                        response_headers = response.headers
+            except Exception as e:
+                print(f"错误：请求时发生异常：{str(e)}")
+                return None
+
+    body_hash = hashlib.sha1(body).hexdigest()
+    if entry is not None and entry['hash'] == body_hash:
+        response_cache.stats['内容未变化'] += 1
+        response_cache.touch(key)
+        return entry['data']
+
+    response_cache.stats['内容已更新'] += 1
+    data = json.loads(body)
+    response_cache.store(key, response_headers, body_hash, data)
+    return data
 
 async def fetch_hot_data(platform):
     """获取指定平台的热搜数据"""
@@ -82,34 +435,229 @@ async def fetch_hot_data(platform):
 
 async def fetch_news_data(source=None, category=None):
     """获取指定来源或类别的新闻数据"""
-    params = {'apiKey': NEWS_API_KEY, 'pageSize': 20}
+    params = {'apiKey': os.environ["NEWS_API_KEY"], 'pageSize': 20}
     if source:
         params['sources'] = source
     if category:
         params['category'] = category
     data = await fetch_data(NEWS_API_URL, params)
     if data and data.get("status") == "ok":
-        print(data)
-        return data.get("articles", [])
+        articles = data.get("articles", [])
+        log_sample('newsapi_response', source=source or category,
+                   total_results=data.get('totalResults'), articles=len(articles),
+                   titles=[article.get('title') for article in articles[:3]])
+        return articles
     print(f"警告：{source or category} API返回错误：{data.get('message') if data else '未知错误'}")
     return []
 
-async def translate_text(text):
-    """使用 translators 翻译文本"""
-    if text is None:
-        return ""
-    try:
-        translated_text = ts.translate_text(text, translator='caiyun', from_language='en', to_language='zh')
-        await asyncio.sleep(3)
-        return translated_text
-    except Exception as e:
-        print(f"翻译错误：{text}，错误信息：{str(e)}")
-        return text
+class AdaptiveRateLimiter:
+    """自适应限速器：请求成功时逐步缩短间隔，失败时成倍拉长间隔"""
+    def __init__(self, interval=1.0, min_interval=0.3, max_interval=30.0):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.next_time = 0
+        self.lock = None
+
+    async def wait(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            loop = asyncio.get_event_loop()
+            delay = self.next_time - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_time = loop.time() + self.interval
+
+    def success(self):
+        self.interval = max(self.min_interval, self.interval * 0.8)
+
+    def failure(self):
+        self.interval = min(self.max_interval, self.interval * 2)
+
+class TranslationCache:
+    """SQLite 翻译缓存，以 (翻译器, 源语言, 目标语言, 文本哈希) 为键，支持 TTL 与 LRU 淘汰"""
+    def __init__(self, path, max_entries=TRANSLATION_CACHE_SIZE, ttl=TRANSLATION_CACHE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.conn = None
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.conn = sqlite3.connect(self.path)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS translations ("
+                "key TEXT PRIMARY KEY, translation TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+        return self.conn
+
+    @staticmethod
+    def make_key(translator, from_language, to_language, text):
+        text_hash = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        return f"{translator}:{from_language}:{to_language}:{text_hash}"
+
+    def get(self, translator, from_language, to_language, text):
+        """查询缓存，未命中或已过期时返回 None"""
+        conn = self.connect()
+        key = self.make_key(translator, from_language, to_language, text)
+        now = time.time()
+        row = conn.execute("SELECT translation, created FROM translations WHERE key = ?", (key,)).fetchone()
+        if row and now - row[1] <= self.ttl:
+            conn.execute("UPDATE translations SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+        if row:
+            conn.execute("DELETE FROM translations WHERE key = ?", (key,))
+        self.misses += 1
+        return None
+
+    def set(self, translator, from_language, to_language, text, translation):
+        conn = self.connect()
+        key = self.make_key(translator, from_language, to_language, text)
+        now = time.time()
+        conn.execute("INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?)", (key, translation, now, now))
+
+    def prune(self):
+        """删除过期条目，并按最近访问时间淘汰超出容量的条目"""
+        conn = self.connect()
+        conn.execute("DELETE FROM translations WHERE created < ?", (time.time() - self.ttl,))
+        conn.execute(
+            "DELETE FROM translations WHERE key IN "
+            "(SELECT key FROM translations ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def close(self):
+        if self.conn is None:
+            return
+        self.prune()
+        self.conn.commit()
+        self.conn.close()
+        self.conn = None
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0
+        print(f"翻译缓存：命中 {self.hits} 次，未命中 {self.misses} 次，命中率 {hit_rate:.1f}%")
+
+class TranslationEngine:
+    """批量翻译引擎：把多条文本合并为少量请求，并在线程池中调用阻塞的 translators"""
+    def __init__(self, translator=TRANSLATOR, from_language='en', to_language='zh', workers=TRANSLATE_WORKERS, cache=None):
+        self.translator = translator
+        self.from_language = from_language
+        self.to_language = to_language
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.limiter = AdaptiveRateLimiter()
+        self.cache = cache
+
+    async def call_translator(self, text):
+        """限速后在线程池中执行一次翻译请求"""
+        await self.limiter.wait()
+        loop = asyncio.get_event_loop()
+
+        def request():
+            # 在线程池中取模块，translators 尚未导入完成时不会阻塞事件循环
+            return get_translators().translate_text(text, translator=self.translator,
+                                                    from_language=self.from_language, to_language=self.to_language)
+
+        metrics.count('translator_calls')
+        try:
+            with metrics.span('translate'):
+                result = await loop.run_in_executor(self.executor, request)
+        except Exception:
+            self.limiter.failure()
+            raise
+        self.limiter.success()
+        return result
+
+    async def translate_single(self, text):
+        """翻译单条文本，失败时返回 None"""
+        try:
+            return await self.call_translator(text)
+        except Exception as e:
+            print(f"翻译错误：{text}，错误信息：{str(e)}")
+            return None
+
+    async def translate_batch(self, texts):
+        """合并翻译一批文本，结果无法按分隔符拆回时逐条翻译"""
+        if len(texts) == 1:
+            return [await self.translate_single(texts[0])]
+        try:
+            result = await self.call_translator(TRANSLATE_DELIMITER.join(texts))
+            parts = [part.strip() for part in re.split(r'\s*#{3}\s*', result.strip())]
+            if len(parts) == len(texts):
+                return parts
+            print(f"批量翻译结果无法拆分（{len(parts)}/{len(texts)}），改为逐条翻译")
+        except Exception as e:
+            print(f"批量翻译错误，改为逐条翻译，错误信息：{str(e)}")
+        metrics.retry('translate', len(texts))
+        return list(await asyncio.gather(*(self.translate_single(text) for text in texts)))
+
+    def make_batches(self, texts):
+        """按 TRANSLATE_BATCH_CHARS 把文本切分为若干批"""
+        batches, current, size = [], [], 0
+        for text in texts:
+            if current and size + len(text) > TRANSLATE_BATCH_CHARS:
+                batches.append(current)
+                current, size = [], 0
+            current.append(text)
+            size += len(text) + len(TRANSLATE_DELIMITER)
+        if current:
+            batches.append(current)
+        return batches
+
+    def cache_get(self, text):
+        if self.cache is None:
+            return None
+        return self.cache.get(self.translator, self.from_language, self.to_language, text)
+
+    def cache_set(self, text, translation):
+        if self.cache is not None:
+            self.cache.set(self.translator, self.from_language, self.to_language, text, translation)
+
+    async def translate_many(self, texts):
+        """翻译一组文本，返回与输入一一对应的列表，空文本返回空字符串，翻译失败返回原文"""
+        normalized = [" ".join(text.split()) if text else "" for text in texts]
+        translations = {}
+        pending = []
+        for text in normalized:
+            if not text or text in translations:
+                continue
+            cached = self.cache_get(text)
+            translations[text] = cached
+            if cached is None:
+                pending.append(text)
+
+        batches = self.make_batches(pending)
+        translated = await asyncio.gather(*(self.translate_batch(batch) for batch in batches))
+        for text, result in zip(pending, [result for batch in translated for result in batch]):
+            if result:
+                translations[text] = result
+                self.cache_set(text, result)
+            else:
+                translations[text] = text
+
+        return [translations[text] if text else "" for text in normalized]
+
+translation_cache = TranslationCache(os.path.join(CACHE_DIR, "translations.sqlite3"))
+translation_engine = TranslationEngine(cache=translation_cache)
+
+def get_classify_semaphore():
+    global classify_semaphore
+    if classify_semaphore is None:
+        classify_semaphore = asyncio.Semaphore(CLASSIFY_CONCURRENCY)
+    return classify_semaphore
+
+async def classify_with_ollama(text, session=None):
+    """使用ollma部署的开源模型判断类别，失败时返回 None"""
+    if session is None:
+        async with aiohttp.ClientSession() as session:
+            return await classify_with_ollama(text, session)
 
-async def classify_with_ollama(text):
-    """使用ollma部署的开源模型判断类别"""
     prompt = f"""请对以下新闻标题（和概要）进行分类，仅返回分类结果：
-    可选分类：科技、财经、国际、社会、体育、娱乐、健康、教育、军事、其他
+    可选分类：{"、".join(CATEGORY_NAMES)}
 
     内容：{text[:1000]}
 
@@ -123,161 +671,991 @@ async def classify_with_ollama(text):
     }
     
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(OLLAMA_API_URL, json=payload, timeout=30) as response:
-                result = await response.json()
-                if 'response' in result:
-                    match = re.search(r'{\s*"category":\s*"([^"]+)"\s*}', result['response'])
-                    return match.group(1) if match else "其他"
-                return "其他"
+        async with get_classify_semaphore():
+            metrics.count('llm_calls')
+            with metrics.span('classify'):
+                async with session.post(OLLAMA_API_URL, json=payload, timeout=30) as response:
+                    result = await response.json()
+            if 'response' in result:
+                match = re.search(r'{\s*"category":\s*"([^"]+)"\s*}', result['response'])
+                return match.group(1) if match else None
+            return None
     except Exception as e:
         print(f"分类失败: {str(e)}")
-        return "其他"
-
-async def format_data(data_list, url_key, is_news=False):
-    """格式化数据为可读文本，并添加序号""" 
-    formatted_data = []
-    for index, item in enumerate(data_list[:30], start=1):
-        title = item.get('title', '无标题') if not is_news else await translate_text(item.get('title', '无标题'))
-        title = title if title is not None else '无标题'
-        title = escape_html(title)
-        url = item.get(url_key, '#')
-        hot_info = f"<i>{item.get('hot')}🔥</i>" if not is_news and item.get('hot') else ""
-
-        if item.get('description'):
-            desc = await translate_text(item.get('description'))
-        elif item.get('desc'):
-            desc = item.get('desc')
+        return None
+
+def parse_batch_categories(response, count):
+    """解析批量分类结果，返回长度为 count 的列表，无法识别的位置为 None"""
+    categories = [None] * count
+    try:
+        result = json.loads(response)
+    except ValueError:
+        return categories
+    if isinstance(result, dict):
+        result = result.get('categories', [])
+    if not isinstance(result, list):
+        return categories
+
+    if all(isinstance(entry, str) for entry in result):
+        # 纯字符串数组只有在长度一致时才能确定对应关系
+        if len(result) == count:
+            categories = [entry if entry in CATEGORY_NAMES else None for entry in result]
+        return categories
+
+    for entry in result:
+        if not isinstance(entry, dict):
+            continue
+        try:
+            index = int(entry.get('id')) - 1
+        except (TypeError, ValueError):
+            continue
+        if 0 <= index < count and entry.get('category') in CATEGORY_NAMES:
+            categories[index] = entry['category']
+    return categories
+
+async def classify_batch(texts, session):
+    """一次请求对多条新闻进行分类，返回与输入对应的列表，未能识别的位置为 None"""
+    lines = "\n".join(f"{index}. {text[:300]}" for index, text in enumerate(texts, start=1))
+    prompt = f"""请对以下 {len(texts)} 条新闻标题（和概要）逐条进行分类，仅返回分类结果：
+    可选分类：{"、".join(CATEGORY_NAMES)}
+
+    内容：
+{lines}
+
+    返回格式：{{"categories": [{{"id": 编号, "category": "分类名称"}}, ...]}}，每条新闻对应一项"""
+
+    payload = {
+        "model": Model,
+        "prompt": prompt,
+        "format": "json",
+        "stream": False
+    }
+
+    try:
+        async with get_classify_semaphore():
+            metrics.count('llm_calls')
+            with metrics.span('classify'):
+                async with session.post(OLLAMA_API_URL, json=payload, timeout=CLASSIFY_BATCH_TIMEOUT) as response:
+                    result = await response.json()
+            return parse_batch_categories(result.get('response', ''), len(texts))
+    except Exception as e:
+        print(f"批量分类失败: {str(e)}")
+        return [None] * len(texts)
+
+async def classify_with_llm(texts):
+    """分批并发调用 LLM 分类，批量结果未覆盖的条目逐条重试，失败的位置为 None"""
+    if not texts:
+        return []
+    async with aiohttp.ClientSession() as session:
+        batches = [texts[i:i + CLASSIFY_BATCH_SIZE] for i in range(0, len(texts), CLASSIFY_BATCH_SIZE)]
+        results = await asyncio.gather(*(classify_batch(batch, session) for batch in batches))
+        categories = [category for batch in results for category in batch]
+
+        missing = [index for index, category in enumerate(categories) if category is None]
+        if missing:
+            print(f"批量分类未覆盖 {len(missing)} 条，逐条重试")
+            metrics.retry('classify', len(missing))
+            retried = await asyncio.gather(*(classify_with_ollama(texts[index], session) for index in missing))
+            for index, category in zip(missing, retried):
+                categories[index] = category
+    return categories
+
+class LocalClassifier:
+    """本地朴素贝叶斯分类器，使用 LLM 的历史分类结果训练，置信度足够时直接作答"""
+    def __init__(self, path, threshold=LOCAL_CLASSIFIER_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self.doc_counts = defaultdict(int)  # 分类 -> 样本数
+        self.token_counts = defaultdict(lambda: defaultdict(int))  # 分类 -> 特征 -> 次数
+        self.token_totals = defaultdict(int)  # 分类 -> 特征总数
+        self.vocab = set()
+        self.local_hits = 0  # 本地直接作答的条目数
+        self.forwarded = 0  # 交给 LLM 的条目数
+        self.compared = []  # (本地置信度, 是否与 LLM 一致)
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                model = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"本地分类器加载失败：{str(e)}")
+            return
+        for category, count in model.get('doc_counts', {}).items():
+            self.doc_counts[category] = count
+        for category, tokens in model.get('token_counts', {}).items():
+            self.token_counts[category].update(tokens)
+            self.token_totals[category] = sum(tokens.values())
+            self.vocab.update(tokens)
+
+    def save(self):
+        self.prune()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        model = {'doc_counts': self.doc_counts, 'token_counts': self.token_counts}
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(model, f, ensure_ascii=False)
+
+    def prune(self):
+        """词表超出上限时淘汰出现次数最少的特征"""
+        if len(self.vocab) <= LOCAL_CLASSIFIER_MAX_VOCAB:
+            return
+        frequency = defaultdict(int)
+        for tokens in self.token_counts.values():
+            for token, count in tokens.items():
+                frequency[token] += count
+        keep = set(sorted(frequency, key=frequency.get, reverse=True)[:LOCAL_CLASSIFIER_MAX_VOCAB])
+        for category, tokens in self.token_counts.items():
+            for token in [token for token in tokens if token not in keep]:
+                del tokens[token]
+            self.token_totals[category] = sum(tokens.values())
+        self.vocab = keep
+
+    @staticmethod
+    def tokenize(text):
+        """中文取相邻两字，英文取单词"""
+        text = re.sub(r'<[^>]+>', ' ', text).lower()
+        tokens = re.findall(r'[a-z]{2,}', text)
+        for segment in re.findall(r'[\u4e00-\u9fff]+', text):
+            tokens.extend(segment[i:i + 2] for i in range(max(len(segment) - 1, 1)))
+        return tokens
+
+    @property
+    def ready(self):
+        return sum(self.doc_counts.values()) >= LOCAL_CLASSIFIER_MIN_SAMPLES
+
+    def learn(self, text, category):
+        if category not in CATEGORY_NAMES:
+            return
+        self.doc_counts[category] += 1
+        for token in self.tokenize(text):
+            self.token_counts[category][token] += 1
+            self.token_totals[category] += 1
+            self.vocab.add(token)
+
+    def predict(self, text):
+        """返回 (分类, 置信度)，尚无训练数据时返回 (None, 0)"""
+        total_docs = sum(self.doc_counts.values())
+        if not total_docs:
+            return None, 0.0
+        tokens = self.tokenize(text)
+        vocab_size = len(self.vocab) + 1
+        scores = {}
+        for category, doc_count in self.doc_counts.items():
+            counts = self.token_counts[category]
+            denominator = self.token_totals[category] + vocab_size
+            score = math.log(doc_count / total_docs)
+            for token in tokens:
+                score += math.log((counts.get(token, 0) + 1) / denominator)
+            scores[category] = score
+        best = max(scores, key=scores.get)
+        normalizer = sum(math.exp(score - scores[best]) for score in scores.values())
+        return best, 1 / normalizer
+
+    def record(self, prediction, category):
+        """记录本地预测与 LLM 结果的对比，用于统计准确率"""
+        predicted, confidence = prediction
+        if predicted is not None and category in CATEGORY_NAMES:
+            self.compared.append((confidence, predicted == category))
+
+    def report(self):
+        total = self.local_hits + self.forwarded
+        if not total:
+            return
+        print(f"本地分类器：直接作答 {self.local_hits}/{total} 条（{self.local_hits / total * 100:.1f}%），阈值 {self.threshold}")
+        for threshold in (0.5, 0.7, 0.8, 0.9, 0.95):
+            above = [agree for confidence, agree in self.compared if confidence >= threshold]
+            if above:
+                print(f"  置信度 ≥ {threshold}：与 LLM 一致 {sum(above)}/{len(above)}（{sum(above) / len(above) * 100:.1f}%）")
+
+    def close(self):
+        self.report()
+        self.save()
+
+local_classifier = LocalClassifier(os.path.join(CACHE_DIR, "classifier.json"))
+
+async def classify_many(texts):
+    """对多条新闻分类：本地分类器置信度足够时直接作答，其余交给 LLM"""
+    categories = [None] * len(texts)
+    predictions = [local_classifier.predict(text) for text in texts]
+    forward = []
+    for index, (category, confidence) in enumerate(predictions):
+        if local_classifier.ready and confidence >= local_classifier.threshold and random.random() >= LOCAL_CLASSIFIER_AUDIT_RATE:
+            categories[index] = category
+            local_classifier.local_hits += 1
+        else:
+            forward.append(index)
+
+    local_classifier.forwarded += len(forward)
+    metrics.count('local_classifier_hits', len(texts) - len(forward))
+    llm_categories = await classify_with_llm([texts[index] for index in forward])
+    for index, category in zip(forward, llm_categories):
+        if category is not None:
+            local_classifier.record(predictions[index], category)
+            local_classifier.learn(texts[index], category)
+        categories[index] = category or "其他"
+    return categories
+
+class NewsItem:
+    """单条新闻/热搜，在获取阶段构建一次，发送时再按目标渲染为 HTML"""
+    __slots__ = ('source', 'title', 'title_zh', 'url', 'hot', 'desc', 'category', 'rank', 'status')
+
+    def __init__(self, source, title, url, hot=None, desc='', title_zh=None, category=None, rank=None):
+        self.source = source
+        self.title = title
+        self.title_zh = title_zh  # 外媒标题的译文
+        self.url = url
+        self.hot = hot
+        self.desc = desc  # 概要（外媒为译文）
+        self.category = category
+        self.rank = rank  # 在本数据源榜单中的排名
+        self.status = 'new'  # new: 首次出现，rising: 排名明显上升，None: 已发布过
+
+    @property
+    def display_title(self):
+        return self.title_zh or self.title
+
+def build_items(source, data_list, url_key, is_news=False):
+    """把接口返回的原始数据转换为 NewsItem 列表"""
+    items = []
+    for rank, raw in enumerate(data_list[:30], start=1):
+        items.append(NewsItem(
+            source=source,
+            title=raw.get('title') or '无标题',
+            url=raw.get(url_key) or '#',
+            hot=None if is_news else raw.get('hot'),
+            desc=raw.get('description') or raw.get('desc') or '',
+            rank=rank,
+        ))
+    return items
+
+def item_key(item):
+    """条目的去重键：优先使用归一化 URL，没有有效链接时使用标题"""
+    basis = None
+    if item.url and item.url != '#':
+        try:
+            basis = normalize_url(item.url)
+        except ValueError:
+            pass
+    if basis is None:
+        basis = " ".join(item.title.split()).lower()
+    return hashlib.sha1(basis.encode('utf-8')).hexdigest()[:16]
+
+class SeenIndex:
+    """已发布条目索引：数据源 -> 去重键 -> [首次出现时间, 最近出现时间, 最近排名, 分类]"""
+    def __init__(self, path, max_age=SEEN_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.entries = defaultdict(dict)
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for source, entries in json.load(f).items():
+                    self.entries[source] = entries
+        except (OSError, ValueError) as e:
+            print(f"已发布条目索引加载失败：{str(e)}")
+
+    def annotate(self, source, items):
+        """标记条目为新条目、上升条目或已发布条目，并带上已知的分类"""
+        known = self.entries.get(source, {})
+        now = time.time()
+        for item in items:
+            entry = known.get(item_key(item))
+            if entry is None or now - entry[1] > self.max_age:
+                item.status = 'new'
+                continue
+            item.category = entry[3]
+            item.status = 'rising' if item.rank is not None and entry[2] - item.rank >= RISING_RANKS else None
+
+    def record(self, source, items):
+        now = time.time()
+        known = self.entries[source]
+        for item in items:
+            key = item_key(item)
+            first_seen = known[key][0] if key in known else now
+            known[key] = [first_seen, now, item.rank, item.category]
+
+    def save(self):
+        now = time.time()
+        compact = {}
+        for source, entries in self.entries.items():
+            entries = {key: entry for key, entry in entries.items() if now - entry[1] <= self.max_age}
+            if entries:
+                compact[source] = entries
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(compact, f, ensure_ascii=False, separators=(',', ':'))
+
+    def close(self):
+        self.save()
+
+seen_index = SeenIndex(os.path.join(CACHE_DIR, "seen.json"))
+
+async def translate_items(items):
+    """批量翻译外媒条目的标题和概要，每个榜单只需一次批量翻译"""
+    texts = [item.title for item in items] + [item.desc for item in items]
+    translated = await translation_engine.translate_many(texts)
+    for item, title, desc in zip(items, translated[:len(items)], translated[len(items):]):
+        item.title_zh = title
+        item.desc = desc
+
+def parse_hot(value):
+    """把热度值（如 1234567、"123万"、"1.2亿"）解析为数字，无法解析时返回 0"""
+    if isinstance(value, (int, float)):
+        return value
+    match = re.search(r'(\d+(?:\.\d+)?)\s*(万|亿)?', str(value or '').replace(',', ''))
+    if not match:
+        return 0
+    number = float(match.group(1))
+    return number * {'万': 1e4, '亿': 1e8}.get(match.group(2), 1)
+
+def format_hot(value):
+    if value >= 1e8:
+        return f"{value / 1e8:.1f}亿"
+    if value >= 1e4:
+        return f"{value / 1e4:.1f}万"
+    return str(int(value))
+
+class StoryCluster:
+    """跨平台的同一事件，由若干近似重复的条目组成，首个条目作为代表"""
+    __slots__ = ('items', 'category')
+
+    def __init__(self, items):
+        self.items = items
+        self.category = None
+
+    @property
+    def representative(self):
+        return self.items[0]
+
+    @property
+    def sources(self):
+        return list(dict.fromkeys(item.source for item in self.items))
+
+    @property
+    def heat(self):
+        return sum(parse_hot(item.hot) for item in self.items)
+
+    @property
+    def status(self):
+        statuses = {item.status for item in self.items}
+        if 'new' in statuses:
+            return 'new'
+        return 'rising' if 'rising' in statuses else None
+
+def title_shingles(title):
+    """去掉空白与标点后取字符 n-gram"""
+    text = re.sub(r'[\W_]+', '', title.lower())
+    if len(text) <= CLUSTER_SHINGLE_SIZE:
+        return {text} if text else set()
+    return {text[i:i + CLUSTER_SHINGLE_SIZE] for i in range(len(text) - CLUSTER_SHINGLE_SIZE + 1)}
+
+MINHASH_PRIME = (1 << 61) - 1
+MINHASH_SEEDS = [(random.Random(i).randrange(1, MINHASH_PRIME), random.Random(-i - 1).randrange(MINHASH_PRIME))
+                 for i in range(CLUSTER_BANDS * CLUSTER_ROWS)]
+
+def same_story(shingles, other):
+    """两个标题是否为同一事件
+
+    短标题中只替换一个词的两条往往是不同的事件（“加息”与“降息”、“北京”与“上海”），Jaccard 相似度却很高，
+    因此要求较短的标题几乎完整地出现在另一个标题中，只允许插入修饰词；较长的标题使用 Jaccard 相似度。
+    """
+    shorter, longer = sorted((shingles, other), key=len)
+    if len(shorter) < CLUSTER_SHORT_SHINGLES:
+        return len(shorter - longer) <= CLUSTER_SHORT_MAX_MISSING
+    return len(shingles & other) / len(shingles | other) >= CLUSTER_THRESHOLD
+
+def minhash(shingles):
+    hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingles]
+    return [min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in MINHASH_SEEDS]
+
+def cluster_items(items):
+    """用 MinHash LSH 把近似重复的标题聚为一类，返回按首次出现顺序排列的 StoryCluster 列表
+
+    同一榜单内的条目本就是不同话题，一个类中每个数据源至多一条；即使经由第三个数据源的条目间接相连也不会合并。
+    """
+    parent = list(range(len(items)))
+    cluster_sources = [{item.source} for item in items]  # 类的根 -> 类中已有的数据源
+
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    shingles = [title_shingles(item.display_title) for item in items]
+    buckets = defaultdict(list)
+    for index, (item, item_shingles) in enumerate(zip(items, shingles)):
+        if not item_shingles:
+            continue
+        signature = minhash(item_shingles)
+        for band in range(CLUSTER_BANDS):
+            key = (band, tuple(signature[band * CLUSTER_ROWS:(band + 1) * CLUSTER_ROWS]))
+            for other in buckets[key]:
+                root, other_root = find(index), find(other)
+                # 两个类中有相同数据源的条目时不合并
+                if root == other_root or cluster_sources[root] & cluster_sources[other_root]:
+                    continue
+                if same_story(shingles[index], shingles[other]):
+                    parent[root] = other_root
+                    cluster_sources[other_root] |= cluster_sources[root]
+            buckets[key].append(index)
+
+    groups = defaultdict(list)
+    for index, item in enumerate(items):
+        groups[find(index)].append(item)
+    return [StoryCluster(group) for group in groups.values()]
+
+def render_item(item, index=None, mark_new=False):
+    """渲染单条新闻为 HTML，index 为 None 时不添加序号，mark_new 时为新条目加标记"""
+    title = escape_html(item.display_title or '无标题')
+    hot_info = f"<i>{escape_html(str(item.hot))}🔥</i>" if item.hot else ""
+
+    desc = item.desc.replace('\n', '') if item.desc else ''
+    if desc:
+        if len(desc) > 150:
+            desc = desc[:100] + '……'
+        desc = "\n\n" + escape_html(desc)
+
+    prefix = f"{index}. " if index is not None else ""
+    if mark_new and item.status == 'new':
+        prefix += "🆕"
+    return f"{prefix}<a href=\"{item.url}\">{title}</a>{hot_info}{desc}"
+
+def render_items(items, start=1, mark_new=False):
+    """渲染带序号的新闻列表"""
+    with metrics.span('format'):
+        return [render_item(item, index, mark_new) for index, item in enumerate(items, start=start)]
+
+def visible_length(text):
+    """Telegram 计算长度的方式：去掉 HTML 标签、还原实体后的 UTF-16 码元数"""
+    return len(html.unescape(re.sub(r'<[^>]*>', '', text)).encode('utf-16-le')) // 2
+
+def pack_messages(blocks, title="", continued_title=None, footer="", max_items=MESSAGE_MAX_ITEMS, limit=TELEGRAM_MESSAGE_LIMIT):
+    """把渲染好的条目依次装入尽量少的消息，返回 [(消息, 条目数), ...]
+
+    blocks 为 (分组标题, 条目 HTML) 列表，分组标题为 None 表示不分组；每条消息中同一分组的第一个条目前加分组标题，
+    分组跨消息时在续页重复。只在条目之间拆分，不会拆开 <a> 等标签；单个条目本身超长时独占一条消息。
+    title 放在第一条消息开头，continued_title（默认与 title 相同）放在后续消息开头，footer 放在最后一条消息末尾，放不下时单独发送。
+    """
+    if continued_title is None:
+        continued_title = title
+    separator = "\n\n"
+    messages = []
+    parts, length, count, group = [], 0, 0, None
+
+    def flush():
+        messages.append(("".join(parts), count))
+
+    for heading, block in blocks:
+        piece = block if heading is None or (parts and heading == group) else f"{heading}{separator}{block}"
+        piece_length = visible_length(piece)
+        if parts and count < max_items and length + len(separator) + piece_length <= limit:
+            parts.extend([separator, piece])
+            length += len(separator) + piece_length
+            count += 1
         else:
-            desc = ''
+            if parts:
+                flush()
+            header = continued_title if messages else title
+            if heading is not None:
+                piece = f"{heading}{separator}{block}"
+                piece_length = visible_length(piece)
+            parts, length, count = [header, piece], visible_length(header) + piece_length, 1
+        group = heading
 
-        if desc:
-            desc = desc.replace('\n', '')
-            if len(desc) > 150:
-                desc = desc[:100] + '……'
-            desc = "\n\n" + escape_html(desc) 
+    if footer:
+        if parts and length + len(separator) + visible_length(footer) <= limit:
+            parts.extend([separator, footer])
         else:
-            desc = ""
+            if parts:
+                flush()
+            parts, count = [footer], 0
+    if parts:
+        flush()
+    return messages
+
+class TokenBucket:
+    """令牌桶：rate 为每秒补充的令牌数，capacity 为允许的突发数量"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = None
+        self.lock = None
+
+    async def acquire(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            loop = asyncio.get_event_loop()
+            while True:
+                now = loop.time()
+                if self.updated is not None:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class TelegramSender:
+    """统一的 Telegram 发送调度器
+
+    所有发送都经过这里：全局、单聊、群组/频道三级令牌桶限速，遇到 RetryAfter 按服务端要求加抖动退避。
+    同一会话内按调用顺序串行发送，不同会话之间互不阻塞，可以并行。
+    """
+    def __init__(self):
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self.chat_buckets = {}
+        self.chat_locks = {}
+
+    @staticmethod
+    def is_group(chat_id):
+        """频道用户名和负数 ID 均视为群组/频道"""
+        return str(chat_id).startswith(('@', '-'))
+
+    def get_chat_bucket(self, chat_id):
+        if chat_id not in self.chat_buckets:
+            if self.is_group(chat_id):
+                self.chat_buckets[chat_id] = TokenBucket(TELEGRAM_GROUP_RATE / 60, TELEGRAM_GROUP_BURST)
+            else:
+                self.chat_buckets[chat_id] = TokenBucket(TELEGRAM_CHAT_RATE, 1)
+        return self.chat_buckets[chat_id]
+
+    def get_chat_lock(self, chat_id):
+        if chat_id not in self.chat_locks:
+            self.chat_locks[chat_id] = asyncio.Lock()
+        return self.chat_locks[chat_id]
 
-        formatted_string = f"{index}. <a href=\"{url}\">{title}</a>{hot_info}{desc}"
-        formatted_data.append(formatted_string)
+    async def call(self, method, chat_id, **kwargs):
+        """限速后调用 bot 的指定方法，处理限流与网络错误重试"""
+        async with self.get_chat_lock(chat_id):
+            for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+                await self.get_chat_bucket(chat_id).acquire()
+                await self.global_bucket.acquire()
+                metrics.count('telegram_calls')
+                try:
+                    with metrics.span('send'):
+                        return await getattr(get_bot(), method)(chat_id=chat_id, **kwargs)
+                except RetryAfter as e:
+                    if attempt == TELEGRAM_MAX_RETRIES:
+                        raise
+                    retry_after = e.retry_after
+                    if hasattr(retry_after, 'total_seconds'):
+                        retry_after = retry_after.total_seconds()
+                    delay = retry_after + random.uniform(0.5, 1.5 + attempt)
+                    print(f"Telegram 限流：{chat_id} 需等待 {retry_after} 秒，{delay:.1f} 秒后重试")
+                except BadRequest:
+                    raise
+                except NetworkError as e:
+                    if attempt == TELEGRAM_MAX_RETRIES:
+                        raise
+                    delay = min(2 ** attempt, 30) * random.uniform(0.5, 1.5)
+                    print(f"Telegram 网络错误：{str(e)}，{delay:.1f} 秒后重试")
+                metrics.retry('send')
+                await asyncio.sleep(delay)
 
-    return formatted_data
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self.call('send_message', chat_id, text=text, **kwargs)
 
-async def send_to_telegram(platform, formatted_data):
-    """发送数据到 Telegram 频道并记录消息 ID"""
-    top = formatted_data[:10]
-    first_hot_search = formatted_data[0] if formatted_data else "无热搜"
-    message = f"<b>{escape_html(platform)}</b> 热点榜单\n" + "\n\n".join(top)
-    sent_message = await bot.send_message(chat_id=TELEGRAM_CHANNEL_ID, text=message, parse_mode='HTML')
+    async def pin_chat_message(self, chat_id, message_id, **kwargs):
+        return await self.call('pin_chat_message', chat_id, message_id=message_id, **kwargs)
 
-    message_info = {
+sender = TelegramSender()
+
+class ForwardTracker:
+    """后台持续消费 get_updates，记录频道消息 ID 到关联群组自动转发消息 ID 的映射"""
+    def __init__(self, group_id):
+        self.group_id = int(group_id)
+        self.forwards = {}  # 频道消息 ID -> 群组消息 ID
+        self.waiters = {}  # 频道消息 ID -> 等待映射结果的 Future
+        self.offset = None
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.consume())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def consume(self):
+        while True:
+            try:
+                updates = await get_bot().get_updates(offset=self.offset, timeout=FORWARD_POLL_TIMEOUT, allowed_updates=['message'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"获取更新失败：{str(e)}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                self.offset = update.update_id + 1
+                self.handle(update.message)
+
+    @staticmethod
+    def get_channel_message_id(message):
+        """取出自动转发消息对应的频道消息 ID，兼容新旧版本的 python-telegram-bot"""
+        origin = getattr(message, 'forward_origin', None)
+        if origin is not None and getattr(origin, 'message_id', None):
+            return origin.message_id
+        return getattr(message, 'forward_from_message_id', None)
+
+    def handle(self, message):
+        if message is None or message.chat.id != self.group_id or not message.is_automatic_forward:
+            return
+        channel_message_id = self.get_channel_message_id(message)
+        if channel_message_id is None:
+            return
+        self.forwards[channel_message_id] = message.message_id
+        waiter = self.waiters.pop(channel_message_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(message.message_id)
+
+    async def wait_for(self, channel_message_id, timeout=FORWARD_TIMEOUT):
+        """等待指定频道消息的自动转发，超时返回 None"""
+        if channel_message_id in self.forwards:
+            return self.forwards[channel_message_id]
+        if channel_message_id not in self.waiters:
+            self.waiters[channel_message_id] = asyncio.get_event_loop().create_future()
+        try:
+            return await asyncio.wait_for(asyncio.shield(self.waiters[channel_message_id]), timeout)
+        except asyncio.TimeoutError:
+            self.waiters.pop(channel_message_id, None)
+            return None
+
+forward_tracker = ForwardTracker(TELEGRAM_GROUP_ID)
+
+def render_ranking(platform, items):
+    """渲染主频道的榜单消息，返回 (消息, 第一条热搜, 消息中的条目数)
+
+    最多展示前 RANKING_SIZE 条，超出单条消息长度时少放几条，剩下的条目交给评论。
+    """
+    top = render_items(items[:RANKING_SIZE], mark_new=True)
+    first_hot_search = render_item(items[0]) if items else "无热搜"
+    title = f"<b>{escape_html(platform)}</b> 热点榜单\n"
+    message, count = pack_messages([(None, block) for block in top], title, max_items=RANKING_SIZE)[0]
+    return message, first_hot_search, count
+
+async def send_to_telegram(platform, message, first_hot_search):
+    """发送已渲染的榜单到 Telegram 频道并记录消息 ID"""
+    sent_message = await sender.send_message(TELEGRAM_CHANNEL_ID, message, parse_mode='HTML')
+
+    # 返回记录的消息信息
+    return {
         'id': sent_message.message_id,
         'name': platform,
         'first_hot_search': first_hot_search  # 记录第一条热搜
     }
 
-    await asyncio.sleep(4)
+async def send_comments(channel_message_id, items, start=11):
+    """等待频道消息自动转发到关联群组后，以评论形式发送剩余条目"""
+    forwarded_message_id = await forward_tracker.wait_for(channel_message_id)
+    if forwarded_message_id is None:
+        print(f"未找到转发的消息 ID：{channel_message_id}")
+        return
 
-    # 获取关联群组中应该被回复的自动转发消息
-    offset = 0
-    forwarded_message_id = None
-    sent_time = sent_message.date.timestamp()
+    formatted_data = render_items(items, start=start, mark_new=True)
+    for comment_message, _ in pack_messages([(None, block) for block in formatted_data]):
+        await sender.send_message(TELEGRAM_GROUP_ID, comment_message, parse_mode='HTML', reply_to_message_id=forwarded_message_id)
 
-    while True:
-        updates = await bot.get_updates(offset=offset)
-        if not updates:
-            break
+def render_cluster(cluster, index):
+    """渲染一个事件：代表条目、与代表标题不同的其他条目，以及多个来源时的来源列表与合计热度
 
-        for update in updates:
-            if update.message and update.message.chat.id == int(TELEGRAM_GROUP_ID):
-                if update.message.date.timestamp() > sent_time and update.message.is_automatic_forward:
-                    forwarded_message_id = update.message.message_id
-                    break
-            offset = update.update_id + 1
+    类中的条目都会记为已发布，因此标题不同的条目也要展示出来，避免误合并的事件从未被发送。
+    """
+    text = render_item(cluster.representative, index)
+    shown = {re.sub(r'[\W_]+', '', cluster.representative.display_title.lower())}
+    for item in cluster.items[1:]:
+        normalized = re.sub(r'[\W_]+', '', item.display_title.lower())
+        if normalized not in shown:
+            shown.add(normalized)
+            text += f"\n↳ <a href=\"{item.url}\">{escape_html(item.display_title)}</a>（{escape_html(item.source)}）"
+    if len(cluster.sources) > 1:
+        heat = f" · 合计 {format_hot(cluster.heat)}🔥" if cluster.heat else ""
+        text += f"\n<i>来源：{escape_html('、'.join(cluster.sources))}{heat}</i>"
+    return text
 
-        if forwarded_message_id is not None:
-            break
+async def process_articles(published):
+    """跨数据源聚类后按事件分类，并把新事件和上升事件发送到分类频道
 
-    if forwarded_message_id is None:
-        print("未找到转发的消息 ID")
-        return message_info  # 返回消息信息
+    published 为按发布顺序排列的 (数据源, NewsItem 列表)。每个事件只分类、发送一次，
+    已发布过的条目沿用上次的分类。
+    """
+    clusters = cluster_items([article for _, articles in published for article in articles])
+    for cluster in clusters:
+        cluster.category = next((item.category for item in cluster.items if item.category), None)
 
-    for i in range(10, len(formatted_data), 10):
-        group = formatted_data[i:i + 10]
-        comment_message = "\n\n".join(group)
-        await bot.send_message(chat_id=TELEGRAM_GROUP_ID, text=comment_message, parse_mode='HTML', reply_to_message_id=forwarded_message_id)
-        await asyncio.sleep(2)
+    unclassified = [cluster for cluster in clusters if cluster.category is None]
+    categories = await classify_many([cluster.representative.display_title for cluster in unclassified])
+    for cluster, category in zip(unclassified, categories):
+        cluster.category = category
+    for cluster in clusters:
+        for item in cluster.items:
+            item.category = cluster.category
+    for source_name, articles in published:
+        seen_index.record(source_name, articles)
 
-    # 返回记录的消息信息
-    return message_info
+    merged = sum(len(cluster.items) - 1 for cluster in clusters)
+    print(f"聚类：{sum(len(articles) for _, articles in published)} 条合并为 {len(clusters)} 个事件（合并 {merged} 条）")
 
-async def process_articles(articles, source_name):
-    categorized = defaultdict(list)
-    for article in articles:
-        category = await classify_with_ollama(article)
-        categorized[category].append(article)
-    
-    # 分频道发送
-    for category, items in categorized.items():
-        channel_id = CATEGORY_CHANNELS.get(category, "@general_news_aggregation")
-        await send_to_category_channel(channel_id, source_name, category, items)
-
-async def send_to_category_channel(channel_id, source, category, items):
-    message = f"【{source} - {category}】最新动态：\n\n" + "\n\n".join(items[:15])
-    await bot.send_message(chat_id=channel_id, text=message, parse_mode='HTML')
-    await asyncio.sleep(2)
-
-async def fetch_and_process(media_list, is_news=False, is_category=False):
-    """获取并处理新闻/热搜数据"""
+    # 每个分类频道汇总为一份摘要，频道之间并行发送
+    digests = {}
+    for cluster in clusters:
+        if cluster.status is not None:
+            channel_id = CATEGORY_CHANNELS.get(cluster.category, "@general_news_aggregation")
+            digests.setdefault(channel_id, CategoryDigest(channel_id)).add(cluster)
+    await asyncio.gather(*(send_to_category_channel(digest) for digest in digests.values()))
+
+class CategoryDigest:
+    """一个分类频道本轮的摘要：收集所有数据源的新事件和上升事件，按数据源分组，渲染为尽量少的消息"""
+    def __init__(self, channel_id):
+        self.channel_id = channel_id
+        self.categories = []  # 本频道收到的分类，未开设频道的分类会合并到综合频道
+        self.sources = {}  # 数据源 -> 事件列表，按首次出现的顺序排列
+
+    def add(self, cluster):
+        if cluster.category not in self.categories:
+            self.categories.append(cluster.category)
+        self.sources.setdefault(cluster.representative.source, []).append(cluster)
+
+    def __len__(self):
+        return sum(len(clusters) for clusters in self.sources.values())
+
+    def render(self):
+        """渲染为消息列表，放不下时在事件之间拆分，续页重复标题和数据源"""
+        title = f"【{escape_html('、'.join(self.categories))}】本轮最新动态"
+        blocks = [(f"<b>{escape_html(source)}</b>", render_cluster(cluster, index))
+                  for source, clusters in self.sources.items()
+                  for index, cluster in enumerate(clusters, start=1)]
+        return [message for message, _ in pack_messages(blocks, f"{title}：\n\n", f"{title}（续）：\n\n")]
+
+async def send_to_category_channel(digest):
+    """把一个分类频道的本轮摘要按顺序发送出去"""
+    with metrics.span('format'):
+        messages = digest.render()
+    print(f"分类频道 {digest.channel_id}：{len(digest)} 个事件，{len(messages)} 条消息")
+    for message in messages:
+        try:
+            await sender.send_message(digest.channel_id, message, parse_mode='HTML')
+        except Exception as e:
+            print(f"发送到分类频道失败：{digest.channel_id}，错误信息：{str(e)}")
+
+async def get_data(item, is_news=False, is_category=False):
+    """获取单个数据源的数据，返回 NewsItem 列表"""
+    if is_category:
+        data = await fetch_news_data(category=item[1])
+    elif is_news:
+        data = await fetch_news_data(source=item[1])
+    else:
+        data = await fetch_hot_data(item[0])
+    return build_items(item[0], data, "url" if is_news else item[1], is_news=is_news)
+
+class SourceResult:
+    """流水线中流转的单个数据源结果"""
+    __slots__ = ('index', 'name', 'is_news', 'items', 'message', 'first_hot_search', 'ranked')
+
+    def __init__(self, index, name, is_news, items):
+        self.index = index  # 数据源在发布顺序中的位置
+        self.name = name
+        self.is_news = is_news
+        self.items = items
+        self.message = None  # 渲染好的榜单消息
+        self.first_hot_search = None
+        self.ranked = 0  # 榜单消息中的条目数，其余条目以评论形式发送
+
+PIPELINE_STOP = object()  # 通知阶段 worker 退出的结束标记
+
+class PipelineStage:
+    """流水线中的一个阶段：workers 个协程从有界队列取结果交给 handler 处理，再把返回值放入所有下游阶段
+
+    handler 返回 None 表示结果在本阶段消费掉，不再向下游传递；出错时原样传给下游，不会卡住后续阶段。
+    """
+    def __init__(self, name, handler, workers=1, finish=None, maxsize=PIPELINE_QUEUE_SIZE):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.finish = finish  # 所有结果处理完后执行一次的协程函数
+        self.maxsize = maxsize
+        self.downstream = []
+        self.queue = None
+        self.tasks = []
+
+    def connect(self, *stages):
+        self.downstream.extend(stages)
+        return self
+
+    def start(self):
+        """启动本阶段及所有下游阶段"""
+        self.queue = asyncio.Queue(self.maxsize)
+        self.tasks = [asyncio.ensure_future(self.work()) for _ in range(self.workers)]
+        for stage in self.downstream:
+            stage.start()
+
+    async def put(self, result):
+        await self.queue.put(result)
+
+    async def work(self):
+        while True:
+            result = await self.queue.get()
+            if result is PIPELINE_STOP:
+                return
+            try:
+                output = await self.handler(result)
+            except Exception as e:
+                print(f"流水线 {self.name} 阶段出错：{result.name}，错误信息：{str(e)}")
+                metrics.error(f"pipeline_{self.name}")
+                output = result
+            if output is not None:
+                for stage in self.downstream:
+                    await stage.put(output)
+
+    async def close(self):
+        """等待已入队的结果处理完毕，执行 finish，然后依次关闭下游阶段"""
+        for _ in self.tasks:
+            await self.queue.put(PIPELINE_STOP)
+        await asyncio.gather(*self.tasks)
+        if self.finish is not None:
+            await self.finish()
+        await asyncio.gather(*(stage.close() for stage in self.downstream))
+
+async def run_pipeline(source_groups, ready):
+    """以流水线方式运行一轮：抓取 → 翻译 → 渲染 → 按顺序发布到主频道，翻译后的结果同时进入聚类分类阶段
+
+    各阶段之间是有界队列，各自有独立的 worker 数，下游处理不过来时上游自动等待。只有主频道榜单需要按数据源顺序发布，
+    先到的结果在发送阶段暂存；ready（置顶消息）完成之前不发布榜单。聚类需要全部数据源，因此分类阶段在收齐后开始。
+    超过 FETCH_DEADLINE 仍未返回的数据源会被丢弃。返回按顺序排列的榜单消息信息，用于快速预览。
+    """
+    jobs = [(item, is_news, is_category) for media_list, is_news, is_category in source_groups for item in media_list]
     first_message_info = []
-    async def get_data(item):
-        if is_category:
-            category = item[1]
-            return await fetch_news_data(category=category)
-        elif is_news:
-            source = item[1]
-            return await fetch_news_data(source=source)
-        else:
-            source = item[0]
-            return await fetch_hot_data(source)
+    fetched_sources = []
+    waiting = {}  # 序号 -> 已渲染但还没轮到发布的结果
+    next_index = 0
+    comment_tasks = []
+
+    async def translate(result):
+        if result.items and result.is_news:
+            await translate_items(result.items)
+        return result
+
+    async def render(result):
+        if result.items:
+            result.message, result.first_hot_search, result.ranked = render_ranking(result.name, result.items)
+        return result
+
+    async def collect(result):
+        # 所有数据源都参与聚类分类，已发布过的条目由 seen_index 标注并沿用上次的分类，不会重复分类和发送
+        if result.items:
+            fetched_sources.append(result)
+        return None
+
+    async def classify():
+        fetched_sources.sort(key=lambda result: result.index)
+        await process_articles([(result.name, result.items) for result in fetched_sources])
+
+    async def publish_one(result):
+        if not result.items:
+            print(f"未能获取到数据：{result.name}")
+            return
+        if result.message is None:
+            result.message, result.first_hot_search, result.ranked = render_ranking(result.name, result.items)
+        message_info = await send_to_telegram(result.name, result.message, result.first_hot_search)
+        if len(result.items) > result.ranked:
+            comment_tasks.append(asyncio.ensure_future(
+                send_comments(message_info['id'], result.items[result.ranked:], start=result.ranked + 1)))
+        first_message_info.append(message_info)
 
-    for item in media_list:
+    async def publish(result):
+        nonlocal next_index
+        waiting[result.index] = result
+        await ready
+        while next_index in waiting:
+            result = waiting.pop(next_index)
+            next_index += 1
+            await publish_one(result)
+        return None
+
+    async def publish_rest():
+        # 个别结果在上游出错丢失时，其余结果在最后按顺序补发
+        for index in sorted(waiting):
+            await publish_one(waiting.pop(index))
+
+    translate_stage = PipelineStage('translate', translate, workers=TRANSLATE_STAGE_WORKERS)
+    render_stage = PipelineStage('render', render, workers=RENDER_STAGE_WORKERS)
+    send_stage = PipelineStage('send', publish, finish=publish_rest)
+    classify_stage = PipelineStage('classify', collect, finish=classify)
+    translate_stage.connect(render_stage, classify_stage)
+    render_stage.connect(send_stage)
+    translate_stage.start()
+
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + FETCH_DEADLINE
+
+    async def fetch(index, job):
+        item, is_news, _ = job
+        items = []
+        try:
+            items = await asyncio.wait_for(get_data(*job), max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            print(f"获取超时，已丢弃：{item[0]}")
+        except Exception as e:
+            print(f"获取失败：{item[0]}，错误信息：{str(e)}")
+        if items:
+            seen_index.annotate(item[0], items)
+        await translate_stage.put(SourceResult(index, item[0], is_news, items))
+
+    for item, _, _ in jobs:
         print(f"正在获取：{item[0]}")
-        data = await get_data(item)
-
-        if data:  # 确保数据不为空
-            format_key = "url" if is_news else item[1]
-            formatted_news = await format_data(data, format_key, is_news=is_news)
-            message_info = await send_to_telegram(item[0], formatted_news)
-            await process_articles(formatted_news, item[0])
-            await asyncio.sleep(2)
-            first_message_info.append(message_info)
-        else:
-            print(f"未能获取到数据：{item[0]}")
+    await asyncio.gather(*(fetch(index, job) for index, job in enumerate(jobs)))
+    await translate_stage.close()
+    await asyncio.gather(*comment_tasks)
     return first_message_info
 
 async def main():
     tz = pytz.timezone('Asia/Shanghai')
     current_time = datetime.now(tz).strftime("%Y-%m-%d %H:%M")
-    init_message = await bot.send_message(chat_id=TELEGRAM_CHANNEL_ID, text=f"北京时间: <b>{current_time}</b>", parse_mode='HTML')
-    await bot.pin_chat_message(chat_id=TELEGRAM_CHANNEL_ID, message_id=init_message.message_id)
-    await asyncio.sleep(2)
 
-    first_message_info = [] # 记录每个榜单的第一条新闻/热搜
-    first_message_info += await fetch_and_process(FOREIGN_MEDIA, is_news=True)
-    first_message_info += await fetch_and_process(CATEGORIES, is_news=True, is_category=True)
-    first_message_info += await fetch_and_process(PLATFROMS)
+    async def send_init_message():
+        init_message = await sender.send_message(TELEGRAM_CHANNEL_ID, f"北京时间: <b>{current_time}</b>", parse_mode='HTML')
+        await sender.pin_chat_message(TELEGRAM_CHANNEL_ID, init_message.message_id)
+
+    # 抓取、翻译与置顶消息同时进行，榜单在置顶消息之后按固定顺序发布
+    init_task = asyncio.ensure_future(send_init_message())
+    pipeline_task = asyncio.ensure_future(run_pipeline([
+        (FOREIGN_MEDIA, True, False),
+        (CATEGORIES, True, True),
+        (PLATFROMS, False, False),
+    ], init_task))
+    prewarm()
+
+    forward_tracker.start()
+    try:
+        await init_task
+        first_message_info = await pipeline_task # 记录每个榜单的第一条新闻/热搜
+    finally:
+        pipeline_task.cancel()
+        await forward_tracker.stop()
 
     if first_message_info:
         jump_message = f"北京时间: <b>{current_time}</b>\n<b>-快-速-预-览-</b>\n\n"
         links = []
 
         for info in first_message_info:
-            link = f"<b><a href='https://t.me/{TELEGRAM_CHANNEL_ID[1:]}/{info['id']}'>☞  {escape_html(info['name'])} 榜单</a></b>\n\n首条: {info['first_hot_search'][3:]}"
-            links.append(link)
-
-        jump_message += "\n\n".join(links)
+            link = f"<b><a href='https://t.me/{TELEGRAM_CHANNEL_ID[1:]}/{info['id']}'>☞  {escape_html(info['name'])} 榜单</a></b>\n\n首条: {info['first_hot_search']}"
+            links.append((None, link))
         
         # 添加相关频道链接
         related_channels = """
@@ -292,8 +1670,24 @@ async def main():
 <a href="https://t.me/entertainment_news_aggregation">娱乐聚合</a>  <a href="https://t.me/general_news_aggregation">其他聚合</a>
 """
         
-        share_message = jump_message + "\n\n" + related_channels + "\n\n<i>自动更新，<a href='https://github.com/Lifelong-Learning-Water/Telegram-Bot'>开源项目</a>，<b><a href='https://t.me/hot_search_aggregation'>热点聚合</a>！</b></i>"
-        await bot.send_message(chat_id=TELEGRAM_CHANNEL_ID, text=share_message, parse_mode='HTML')
+        footer = related_channels + "\n\n<i>自动更新，<a href='https://github.com/Lifelong-Learning-Water/Telegram-Bot'>开源项目</a>，<b><a href='https://t.me/hot_search_aggregation'>热点聚合</a>！</b></i>"
+        for share_message, _ in pack_messages(links, jump_message, footer=footer, max_items=len(links)):
+            await sender.send_message(TELEGRAM_CHANNEL_ID, share_message, parse_mode='HTML')
+
+def close_caches():
+    """保存并关闭所有跨运行的缓存"""
+    translation_cache.close()
+    local_classifier.close()
+    seen_index.close()
+    response_cache.close()
+
+MODULE_LOADED = time.perf_counter()
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    metrics.observe('startup', MODULE_LOADED - MODULE_STARTED)
+    try:
+        asyncio.run(main())
+    finally:
+        close_caches()
+        report_startup()
+        metrics.export()
\ No newline at end of file
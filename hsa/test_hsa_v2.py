@@ -0,0 +1,138 @@
+"""hsa_v2 的回归测试：python -m pytest hsa"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from hsa_v2 import (TRANSLATE_DELIMITER, NewsItem, StoryCluster, TranslationEngine, cluster_items,  # noqa: E402
+                    pack_messages, parse_batch_categories, render_cluster, visible_length)
+
+class ClusterItemsTest(unittest.TestCase):
+    def test_same_source_items_not_merged_through_third_source(self):
+        items = [
+            NewsItem('微博', '苹果公司今天发布新款手机', '#'),
+            NewsItem('微博', '苹果公司今天发布新款电脑', '#'),
+            NewsItem('百度', '苹果公司今天发布新款手机和电脑', '#'),
+        ]
+        clusters = cluster_items(items)
+        for cluster in clusters:
+            sources = [item.source for item in cluster.items]
+            self.assertEqual(len(sources), len(set(sources)))
+        titles = {cluster.representative.title for cluster in clusters}
+        self.assertIn('苹果公司今天发布新款手机', titles)
+        self.assertIn('苹果公司今天发布新款电脑', titles)
+
+    def test_near_duplicates_from_different_sources_merged(self):
+        items = [
+            NewsItem('微博', '苹果公司今天发布新款手机', '#'),
+            NewsItem('百度', '苹果公司今天发布了新款手机', '#'),
+        ]
+        self.assertEqual(len(cluster_items(items)), 1)
+
+    def test_titles_differing_in_one_word_not_merged(self):
+        pairs = [
+            ('Fed raises rates by 25 basis points', 'Fed cuts rates by 25 basis points'),
+            ('北京今日最高气温38度', '上海今日最高气温38度'),
+            ('苹果公司今天发布新款手机', '苹果公司今天发布新款电脑'),
+        ]
+        for first, second in pairs:
+            with self.subTest(first=first, second=second):
+                items = [NewsItem('微博', first, '#'), NewsItem('百度', second, '#')]
+                self.assertEqual(len(cluster_items(items)), 2)
+
+    def test_render_cluster_shows_members_with_different_titles(self):
+        cluster = StoryCluster([
+            NewsItem('微博', '苹果公司今天发布新款手机', 'https://a.example/1'),
+            NewsItem('百度', '苹果公司今天发布了新款手机', 'https://b.example/2'),
+            NewsItem('知乎', '苹果公司今天发布新款手机！', 'https://c.example/3'),
+        ])
+        text = render_cluster(cluster, 1)
+        self.assertIn('苹果公司今天发布了新款手机', text)
+        self.assertNotIn('https://c.example/3', text)
+
+class PackMessagesTest(unittest.TestCase):
+    def test_visible_length_counts_utf16_units_without_tags(self):
+        self.assertEqual(visible_length('<a href="https://example.com">😀&amp;</a>x'), 4)
+
+    def test_utf16_limit_with_emoji_and_entities(self):
+        # 每个条目 HTML 中 60 个字符，Telegram 计为 10 个表情 × 2 + 10 个 & = 30 个码元
+        block = '😀' * 10 + '&amp;' * 10
+        messages = pack_messages([(None, block)] * 7, max_items=100, limit=100)
+        self.assertEqual([count for _, count in messages], [3, 3, 1])
+        for message, _ in messages:
+            self.assertLessEqual(visible_length(message), 100)
+
+    def test_max_items_cap(self):
+        messages = pack_messages([(None, f'item {index}') for index in range(7)], max_items=3)
+        self.assertEqual([count for _, count in messages], [3, 3, 1])
+
+    def test_headings_repeated_on_continuation_messages(self):
+        blocks = [('<b>A</b>', 'a1'), ('<b>A</b>', 'a2'), ('<b>A</b>', 'a3'), ('<b>B</b>', 'b1')]
+        messages = pack_messages(blocks, title='标题\n\n', continued_title='标题（续）\n\n', max_items=2)
+        self.assertEqual([message for message, _ in messages], [
+            '标题\n\n<b>A</b>\n\na1\n\na2',
+            '标题（续）\n\n<b>A</b>\n\na3\n\n<b>B</b>\n\nb1',
+        ])
+
+    def test_footer_spills_into_its_own_message(self):
+        footer = 'f' * 40
+        messages = pack_messages([(None, 'x' * 50)], footer=footer, limit=60)
+        self.assertEqual(messages, [('x' * 50, 1), (footer, 0)])
+
+    def test_footer_appended_when_it_fits(self):
+        messages = pack_messages([(None, 'x' * 10)], footer='footer', limit=60)
+        self.assertEqual(messages, [('x' * 10 + '\n\nfooter', 1)])
+
+class ParseBatchCategoriesTest(unittest.TestCase):
+    def test_entries_matched_by_id(self):
+        response = '{"categories": [{"id": 2, "category": "体育"}, {"id": "1", "category": "科技"}]}'
+        self.assertEqual(parse_batch_categories(response, 3), ['科技', '体育', None])
+
+    def test_invalid_ids_and_unknown_categories_ignored(self):
+        response = '[{"id": 0, "category": "科技"}, {"id": 4, "category": "体育"}, {"id": "x", "category": "体育"}, ' \
+                   '{"id": 1, "category": "天气"}, "体育", {"id": 2, "category": "财经"}]'
+        self.assertEqual(parse_batch_categories(response, 3), [None, '财经', None])
+
+    def test_plain_string_array_only_used_when_lengths_match(self):
+        self.assertEqual(parse_batch_categories('["科技", "未知"]', 2), ['科技', None])
+        self.assertEqual(parse_batch_categories('["科技", "体育"]', 3), [None, None, None])
+
+    def test_malformed_response(self):
+        self.assertEqual(parse_batch_categories('not json', 2), [None, None])
+        self.assertEqual(parse_batch_categories('{"categories": "科技"}', 2), [None, None])
+
+class TranslateBatchTest(unittest.IsolatedAsyncioTestCase):
+    def make_engine(self, translate):
+        engine = TranslationEngine(workers=1)
+        self.calls = []
+
+        async def call_translator(text):
+            self.calls.append(text)
+            return translate(text)
+
+        engine.call_translator = call_translator
+        return engine
+
+    async def test_batch_split_by_delimiter(self):
+        engine = self.make_engine(lambda text: text.replace('apple', '苹果').replace('pear', '梨'))
+        self.assertEqual(await engine.translate_batch(['apple', 'pear']), ['苹果', '梨'])
+        self.assertEqual(self.calls, [TRANSLATE_DELIMITER.join(['apple', 'pear'])])
+
+    async def test_falls_back_to_single_requests_when_delimiters_are_lost(self):
+        engine = self.make_engine(lambda text: '合并后的译文' if TRANSLATE_DELIMITER in text else f'译文：{text}')
+        self.assertEqual(await engine.translate_batch(['a', 'b', 'c']), ['译文：a', '译文：b', '译文：c'])
+        self.assertEqual(len(self.calls), 4)
+
+    async def test_falls_back_to_single_requests_on_error(self):
+        def translate(text):
+            if TRANSLATE_DELIMITER in text:
+                raise RuntimeError('batch failed')
+            if text == 'b':
+                raise RuntimeError('single failed')
+            return f'译文：{text}'
+
+        engine = self.make_engine(translate)
+        self.assertEqual(await engine.translate_batch(['a', 'b']), ['译文：a', None])
+
+if __name__ == '__main__':
+    unittest.main()
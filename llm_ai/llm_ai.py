@@ -1,74 +1,376 @@
+import time
+MODULE_STARTED = time.perf_counter()  # 模块开始加载的时间，用于统计冷启动耗时
 import os
+import sys
 import json
-from cryptography.fernet import Fernet
-from openai import OpenAI
+import hmac
+import hashlib
+import sqlite3
+import importlib
 from telegram import Update
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
 import uuid
 import asyncio
-from git import Repo
-from collections import defaultdict
-from threading import Lock
+from collections import defaultdict, deque, OrderedDict
+from urllib.parse import urlparse
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
 
 development = False
+DATA_PATH = 'llm_ai/user_data.sqlite3'
+LEGACY_DATA_PATH = 'llm_ai/user_data.enc'  # 旧版整体加密的数据文件，首次启动时迁移到 DATA_PATH
+FLUSH_INTERVAL = 5  # 修改后批量写回数据库的间隔（秒）
+GIT_SYNC_INTERVAL = 600  # 把累计的修改合并为一次 git 提交并推送的间隔（秒）
+COMPACT_FREE_RATIO = 0.25  # 数据库空闲页超过这个比例时在提交前执行 VACUUM
+HISTORY_CACHE_BYTES = int(os.environ.get("LLM_AI_HISTORY_CACHE_MB", 64)) * 1024 * 1024  # 内存中对话历史的大致上限，超出时换出最久未用的对话
+USER_FIELDS = ('openai_token', 'base_url', 'model', 'current_conversation')  # 需要持久化的用户设置
+
+LLM_CONCURRENCY = int(os.environ.get("LLM_AI_CONCURRENCY", 8))  # 全局同时进行的模型请求数
+LLM_TIMEOUT = float(os.environ.get("LLM_AI_TIMEOUT", 120))  # 模型请求的默认超时时间（秒）
+ENDPOINT_TIMEOUTS = json.loads(os.environ.get("LLM_AI_ENDPOINT_TIMEOUTS", "{}"))  # 按域名单独设置的超时时间，如 {"api.openai.com": 60}
+LLM_MAX_RETRIES = 2  # 客户端对连接错误、429 与 5xx 的自动重试次数
+CLIENT_POOL_SIZE = 32  # 最多保留的客户端数，超出时关闭最久未使用的空闲客户端
+USER_QUEUE_LIMIT = int(os.environ.get("LLM_AI_USER_QUEUE", 5))  # 每个用户最多排队等待的消息数
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("LLM_AI_CONTEXT_TOKENS", 4000))  # 每次请求发送的上下文（摘要 + 最近对话）的 token 预算
+SUMMARY_TOKEN_BUDGET = 500  # 滚动摘要的目标长度（token）
+SUMMARY_TRIGGER_TOKENS = 400  # 窗口之前尚未摘要的消息累计超过这么多 token 时才更新摘要
+SUMMARY_TRIGGER_MESSAGES = 10  # 或累计超过这么多条消息时更新摘要
+MESSAGE_TOKEN_OVERHEAD = 4  # 每条消息在角色、分隔符上的额外 token 数
+
+STREAM_REPLIES = os.environ.get("LLM_AI_STREAM", "1") != "0"  # 是否以流式方式边生成边编辑回复消息
+STREAM_EDIT_INTERVAL = 1.5  # 流式回复时两次编辑消息的最小间隔（秒），避免触发 Telegram 的编辑限流
+TELEGRAM_MESSAGE_LIMIT = 4096  # 单条消息的最大长度（UTF-16 码元），超出时续写到新消息
+PREWARM = os.environ.get("LLM_AI_PREWARM", "1") != "0"  # 是否在连接 Telegram 的同时于后台线程加载用户数据和 openai
+
+import_profile = {}  # 模块名 -> 延迟导入耗时（秒）
+
+def lazy_import(name):
+    """首次使用时才导入较重的模块（cryptography、openai、GitPython），并记录导入耗时
+
+    总是经过 importlib：预热线程正在导入同一模块时会等待其导入完成，而不是从 sys.modules 取到尚未初始化完的模块。
+    """
+    imported = name in sys.modules
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    if not imported:
+        import_profile.setdefault(name, time.perf_counter() - start)
+    return module
+
+def new_user():
+    return {
+        'openai_token': None,
+        'base_url': None,
+        'model': None,
+        'conversations': {},
+        'current_conversation': None
+    }
+
+class UserStore(dict):
+    """按需加载的用户表：首次访问某个用户时才从数据库读取其设置和对话列表（不含消息内容）"""
+    def __init__(self, manager):
+        super().__init__()
+        self.manager = manager
+
+    def __missing__(self, user_id):
+        user = self.manager.load_user(user_id)
+        self[user_id] = user
+        return user
 
 class UserDataManager:
-    def __init__(self, file_path, key):
+    """用户数据存储：在 SQLite 中按用户设置、对话、消息分条加密保存
+
+    修改后只标记为待写回，由后台任务每 FLUSH_INTERVAL 秒批量写入；保存一条消息只追加该对话新增的消息，
+    不会读写其他用户的数据。git 同步每 GIT_SYNC_INTERVAL 秒进行一次，期间的所有修改合并为一次提交。
+    数据库写入和 git 操作都在单独的线程中串行执行，不阻塞事件循环。数据库使用 WAL 模式，事件循环中的读取走单独的只读连接，
+    不经过写入线程的锁，写入事务或 VACUUM 进行中也不会被阻塞。
+    用户和对话历史都按需加载，对话历史按最近使用保留在内存中，总量超过 HISTORY_CACHE_BYTES 时换出已写回的冷对话。
+    """
+    def __init__(self, file_path, key, legacy_path=None):
         self.file_path = file_path
-        self.cipher = Fernet(key)
-        self.user_data = defaultdict(lambda: {
-            'openai_token': None,
-            'base_url': None,
-            'model': None,
-            'conversations': {},
-            'current_conversation': None
-        })
+        self.cipher = lazy_import('cryptography.fernet').Fernet(key)
+        self.key_secret = hashlib.sha256(b'llm_ai row key:' + (key.encode() if isinstance(key, str) else key)).digest()
+        self.user_data = UserStore(self)
+        self.histories = OrderedDict()  # 已加载历史的 (用户 ID, 对话 ID) -> 估算的内存占用，按最近使用排序
+        self.pinned = defaultdict(int)  # (用户 ID, 对话 ID) -> 正在使用该历史的请求数，使用中不会被换出
+        self.history_budget = HISTORY_CACHE_BYTES
+        self.dirty_users = set()
+        self.dirty_conversations = {}  # (用户 ID, 对话 ID) -> None，用 dict 保持修改顺序，新对话按创建顺序写入
+        self.persisted = {}  # (用户 ID, 对话 ID) -> 已写入数据库的消息条数
+        self.writing = set()  # 正在写入数据库的 (用户 ID, 对话 ID)，写入完成前不会被换出
         self.lock = Lock()
-        self.load_user_data()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending_commit = False  # 是否有尚未提交到 git 的写入
+        self.removed_paths = []  # 需要在下次 git 提交中删除的文件
+        self.last_sync = time.monotonic()
+        self.connection = self.connect()
+        self.reader = sqlite3.connect(self.file_path, check_same_thread=False)  # 只在事件循环中使用
+        if legacy_path and os.path.exists(legacy_path):
+            self.migrate(legacy_path)
+
+    def connect(self):
+        """打开数据库。数据库会提交到 git，因此行的主键只保存用户 ID、对话 ID 的 HMAC（见 row_key），不以明文保存任何标识"""
+        connection = sqlite3.connect(self.file_path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_key TEXT PRIMARY KEY,
+                data BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS conversations (
+                user_key TEXT NOT NULL,
+                conversation_key TEXT NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (user_key, conversation_key)
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                user_key TEXT NOT NULL,
+                conversation_key TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (user_key, conversation_key, seq)
+            );
+        """)
+        return connection
+
+    def row_key(self, value):
+        """用户 ID、对话 ID 在数据库中的键：以 CRYPTOGRAPHY_KEY 派生的密钥计算的 HMAC-SHA256"""
+        return hmac.new(self.key_secret, str(value).encode(), hashlib.sha256).hexdigest()
+
+    def row_keys(self, key):
+        """把 (用户 ID, 对话 ID, 序号...) 中的 ID 换成 row_key，其余部分保持不变"""
+        return tuple(self.row_key(part) for part in key[:2]) + key[2:]
+
+    def encrypt(self, data):
+        # 在开发模式下直接保存未加密的数据
+        return data if development else self.cipher.encrypt(data)
+
+    def decrypt(self, blob):
+        return json.loads(blob if development else self.cipher.decrypt(blob))
+
+    def load_user(self, user_id):
+        """读取一个用户的设置和对话列表，对话历史在 load_history 中另行加载"""
+        user_key = self.row_key(user_id)
+        row = self.reader.execute("SELECT data FROM users WHERE user_key = ?", (user_key,)).fetchone()
+        conversations = self.reader.execute(
+            "SELECT data FROM conversations WHERE user_key = ? ORDER BY rowid", (user_key,)).fetchall()
+        user = new_user()
+        if row is not None:
+            user.update(self.decrypt(row[0]))
+        for blob, in conversations:
+            metadata = self.decrypt(blob)
+            user['conversations'][metadata.pop('conversation_id')] = metadata
+        return user
+
+    def load_history(self, user_id, conversation_id):
+        """返回对话历史，不在内存中时从数据库读取"""
+        key = (str(user_id), conversation_id)
+        conversation = self.user_data[key[0]]['conversations'][conversation_id]
+        if 'history' not in conversation:
+            rows = self.reader.execute(
+                "SELECT data FROM messages WHERE user_key = ? AND conversation_key = ? ORDER BY seq",
+                self.row_keys(key)).fetchall()
+            conversation['history'] = [self.decrypt(blob) for blob, in rows]
+            self.persisted[key] = len(rows)
+        self.touch(key, conversation['history'])
+        self.evict()
+        return conversation['history']
+
+    def touch(self, key, history):
+        self.histories[key] = sum(len(message.get('content') or '') * 2 + 100 for message in history)
+        self.histories.move_to_end(key)
+
+    def evict(self):
+        """换出最久未用的对话历史，直到总量不超过预算；未写回或正在使用的对话不会被换出"""
+        total = sum(self.histories.values())
+        for key in list(self.histories):
+            if total <= self.history_budget:
+                break
+            if self.pinned.get(key) or key in self.dirty_conversations or key in self.writing:
+                continue
+            total -= self.histories.pop(key)
+            user = self.user_data.get(key[0])
+            conversation = user['conversations'].get(key[1]) if user else None
+            if conversation is not None:
+                conversation.pop('history', None)
+
+    @contextmanager
+    def pin(self, user_id, conversation_id):
+        """加载对话历史并在使用期间固定在内存中"""
+        key = (str(user_id), conversation_id)
+        self.pinned[key] += 1
+        try:
+            yield self.load_history(user_id, conversation_id)
+        finally:
+            self.pinned[key] -= 1
+            if not self.pinned[key]:
+                del self.pinned[key]
+            conversation = self.user_data[key[0]]['conversations'].get(conversation_id)
+            if conversation is not None and 'history' in conversation:
+                self.touch(key, conversation['history'])
+
+    def migrate(self, legacy_path):
+        """把旧版整体加密的数据文件导入数据库，然后删除旧文件"""
+        with open(legacy_path, 'rb') as f:
+            data = f.read()
+        for user_id, settings in json.loads(data if development else self.cipher.decrypt(data)).items():
+            user = self.user_data[user_id]
+            user.update(settings)
+            user.pop('is_processing', None)
+            self.dirty_users.add(user_id)
+            self.dirty_conversations.update(dict.fromkeys((user_id, conversation_id) for conversation_id in user['conversations']))
+        self.write(self.collect())
+        self.user_data.clear()  # 迁移完成后改为按需从数据库加载
+        os.remove(legacy_path)
+        self.removed_paths.append(legacy_path)
+        print(f"已把 {legacy_path} 迁移到 {self.file_path}")
+
+    def save_user_data(self, user_id, conversation_id=None):
+        """标记用户设置（以及指定对话）需要写回，实际写入由后台任务批量完成"""
+        user_id = str(user_id)
+        self.dirty_users.add(user_id)
+        if conversation_id is not None:
+            self.dirty_conversations[(user_id, conversation_id)] = None
+
+    def collect(self):
+        """在事件循环中取出待写回的数据并序列化，返回交给 write 的记录列表"""
+        users, self.dirty_users = self.dirty_users, set()
+        conversations, self.dirty_conversations = self.dirty_conversations, {}
+        records = []
+        for user_id in users:
+            settings = {field: self.user_data[user_id].get(field) for field in USER_FIELDS}
+            records.append(('user', (user_id,), json.dumps(settings).encode()))
+        for key in conversations:
+            user_id, conversation_id = key
+            conversation = self.user_data[user_id]['conversations'].get(conversation_id)
+            if conversation is None:
+                self.persisted.pop(key, None)
+                records.append(('delete', key, None))
+                continue
+            metadata = {name: value for name, value in conversation.items() if name != 'history'}
+            metadata['conversation_id'] = conversation_id  # 数据库中只有对话 ID 的 HMAC，原 ID 随加密数据保存
+            records.append(('conversation', key, json.dumps(metadata).encode()))
+            history = conversation.get('history')
+            if history is None:
+                continue
+            start = min(self.persisted.get(key, 0), len(history))
+            for seq in range(start, len(history)):
+                records.append(('message', key + (seq,), json.dumps(history[seq]).encode()))
+            records.append(('truncate', key + (len(history),), None))
+            self.persisted[key] = len(history)
+        return records
+
+    def write(self, records):
+        """在存储线程中加密并在一个事务内写入数据库，主键中的 ID 换成 row_key"""
+        statements = {
+            'user': "INSERT INTO users (user_key, data) VALUES (?, ?) "
+                    "ON CONFLICT(user_key) DO UPDATE SET data = excluded.data",
+            'conversation': "INSERT INTO conversations (user_key, conversation_key, data) VALUES (?, ?, ?) "
+                            "ON CONFLICT(user_key, conversation_key) DO UPDATE SET data = excluded.data",
+            'message': "INSERT OR REPLACE INTO messages (user_key, conversation_key, seq, data) VALUES (?, ?, ?, ?)",
+            'truncate': "DELETE FROM messages WHERE user_key = ? AND conversation_key = ? AND seq >= ?",
+        }
+        with self.lock, self.connection:
+            for kind, key, data in records:
+                key = self.row_keys(key)
+                if kind == 'delete':
+                    self.connection.execute("DELETE FROM messages WHERE user_key = ? AND conversation_key = ?", key)
+                    self.connection.execute("DELETE FROM conversations WHERE user_key = ? AND conversation_key = ?", key)
+                elif data is None:
+                    self.connection.execute(statements[kind], key)
+                else:
+                    self.connection.execute(statements[kind], key + (self.encrypt(data),))
+            self.pending_commit = True
+
+    async def flush(self):
+        """把待写回的数据批量写入数据库，失败时重新标记，下次再写"""
+        if not self.dirty_users and not self.dirty_conversations:
+            return
+        users, conversations = set(self.dirty_users), dict(self.dirty_conversations)
+        records = self.collect()
+        # 写入提交之前读连接看不到这些消息，期间不能换出对应的历史，否则重新加载会读到旧数据
+        self.writing.update(conversations)
+        try:
+            await asyncio.get_event_loop().run_in_executor(self.executor, self.write, records)
+        except Exception as e:
+            print(f"用户数据写入失败：{str(e)}")
+            self.dirty_users |= users
+            self.dirty_conversations.update(conversations)
+            for key in conversations:
+                self.persisted.pop(key, None)
+            return
+        finally:
+            self.writing.difference_update(conversations)
+        self.evict()
 
-    def load_user_data(self):
-        with self.lock:
-            if os.path.exists(self.file_path):
-                with open(self.file_path, 'rb') as f:
-                    if development:
-                        # 在开发模式下直接读取未加密的数据
-                        decrypted_data = f.read()
-                    else:
-                        # 在生产模式下读取加密的数据
-                        encrypted_data = f.read()
-                        decrypted_data = self.cipher.decrypt(encrypted_data)
-
-                    # 将加载的数据转换为 defaultdict
-                    loaded_data = json.loads(decrypted_data)
-                    self.user_data = defaultdict(lambda: {
-                        'openai_token': None,
-                        'base_url': None,
-                        'model': None,
-                        'conversations': {},
-                        'current_conversation': None
-                    }, loaded_data)
-
-    def save_user_data(self):
+    def compact(self):
+        """数据库空闲页较多时执行 VACUUM，减小提交到 git 的文件体积，然后执行检查点"""
         with self.lock:
-            if development:
-                # 在开发模式下直接写入未加密的数据
-                with open(self.file_path, 'w') as f:
-                    json.dump(self.user_data, f)
-            else:
-                # 在生产模式下写入加密的数据
-                encrypted_data = self.cipher.encrypt(json.dumps(self.user_data).encode())
-                with open(self.file_path, 'wb') as f:
-                    f.write(encrypted_data)
-            self.commit_changes()
+            page_count = self.connection.execute("PRAGMA page_count").fetchone()[0]
+            free_count = self.connection.execute("PRAGMA freelist_count").fetchone()[0]
+            if page_count and free_count / page_count > COMPACT_FREE_RATIO:
+                self.connection.execute("VACUUM")
+            # 把 WAL 中的内容写回主文件，提交到 git 的数据库文件本身即是完整的
+            self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
 
     def commit_changes(self):
-        repo = Repo(os.getcwd())
+        if not self.pending_commit:
+            return
+        self.compact()
+        repo = lazy_import('git').Repo(os.getcwd())
         repo.index.add([self.file_path])
-        repo.index.commit("Update user_data.json")
+        if self.removed_paths:
+            repo.index.remove(self.removed_paths)
+        repo.index.commit("Update user data")
         origin = repo.remote(name='origin')
         origin.push()
-
-user_data_manager = UserDataManager('llm_ai/user_data.enc', os.environ['CRYPTOGRAPHY_KEY'])
+        self.pending_commit = False
+        self.removed_paths = []
+
+    async def sync(self):
+        """在存储线程中把累计的修改提交并推送到 git"""
+        self.last_sync = time.monotonic()
+        try:
+            await asyncio.get_event_loop().run_in_executor(self.executor, self.commit_changes)
+        except Exception as e:
+            print(f"用户数据同步失败：{str(e)}")
+
+    async def run_background(self):
+        """后台任务：定期批量写回，并按 GIT_SYNC_INTERVAL 合并提交"""
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await self.flush()
+            if time.monotonic() - self.last_sync >= GIT_SYNC_INTERVAL:
+                await self.sync()
+
+    async def close(self):
+        await self.flush()
+        await self.sync()
+
+user_data_manager = None  # 首次使用时才解密加载，见 get_user_data_manager()
+user_data_manager_lock = Lock()
+
+def get_user_data_manager():
+    global user_data_manager
+    with user_data_manager_lock:
+        if user_data_manager is None:
+            start = time.perf_counter()
+            user_data_manager = UserDataManager(DATA_PATH, os.environ['CRYPTOGRAPHY_KEY'], legacy_path=LEGACY_DATA_PATH)
+            import_profile['user_data'] = time.perf_counter() - start
+    return user_data_manager
+
+def prewarm():
+    """在后台线程中加载用户数据并导入 openai，与 Telegram 的连接过程重叠进行，完成后打印冷启动耗时"""
+    try:
+        get_user_data_manager()
+        lazy_import('openai')
+    except Exception as e:
+        print(f"预热失败：{str(e)}")
+    print(f"冷启动：模块加载 {MODULE_LOADED - MODULE_STARTED:.2f} 秒")
+    for name, seconds in sorted(import_profile.items(), key=lambda entry: -entry[1]):
+        print(f"  延迟加载 {name}：{seconds:.2f} 秒")
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = "Welcome to LLM AI!\nThis bot is open source!\n\nhttps://github.com/Alpha-Water/Telegram-Bot"
@@ -94,16 +396,16 @@ async def set_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=user_id, text="Please provide Token, Interface Address and Model Name.\nFormat: /set <token> <url> <model>")
         return
 
-    user_settings = user_data_manager.user_data[str(user_id)]
+    user_settings = get_user_data_manager().user_data[str(user_id)]
     user_settings['openai_token'] = context.args[0]
     user_settings['base_url'] = context.args[1]
     user_settings['model'] = context.args[2]
-    user_data_manager.save_user_data()  # 保存用户数据
+    get_user_data_manager().save_user_data(user_id)  # 保存用户数据
     await context.bot.send_message(chat_id=user_id, text="The parameter has been set.\nPlease use /new_conversation <code name> to create a new conversation.")
 
 async def new_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_chat.id
-    user_settings = user_data_manager.user_data[str(user_id)]
+    user_settings = get_user_data_manager().user_data[str(user_id)]
 
     if len(context.args) == 0:
         await context.bot.send_message(chat_id=user_id, text="Please provide a conversation code name.\nFormat: /new_conversation <code name>")
@@ -122,12 +424,12 @@ async def new_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
         'history': []
     }
     user_settings['current_conversation'] = conversation_id
-    user_data_manager.save_user_data()  # 保存用户数据
+    get_user_data_manager().save_user_data(user_id, conversation_id)  # 保存用户数据
     await context.bot.send_message(chat_id=user_id, text=f"New conversation created.\nID: {conversation_id}\nName: {conversation_name}")
 
 async def list_conversations(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_chat.id
-    conversations = user_data_manager.user_data[str(user_id)]['conversations']
+    conversations = get_user_data_manager().user_data[str(user_id)]['conversations']
     if not conversations:
         await context.bot.send_message(chat_id=user_id, text="You don't have any conversations yet.")
         return
@@ -142,13 +444,13 @@ async def switch_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
 
     conversation_identifier = context.args[0]
-    user_settings = user_data_manager.user_data[str(user_id)]
+    user_settings = get_user_data_manager().user_data[str(user_id)]
     conversations = user_settings['conversations']
 
     # 尝试通过 ID 切换
     if conversation_identifier in conversations:
         user_settings['current_conversation'] = conversation_identifier
-        user_data_manager.save_user_data()  # 保存用户数据
+        get_user_data_manager().save_user_data(user_id)  # 保存用户数据
         await context.bot.send_message(chat_id=user_id, text=f"Switched to Conversation ID: {conversation_identifier[:5]}..., code name: {conversations[conversation_identifier]['name']}.")
         return
 
@@ -156,7 +458,7 @@ async def switch_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE
     for cid, conv in conversations.items():
         if conv['name'] == conversation_identifier:
             user_settings['current_conversation'] = cid
-            user_data_manager.save_user_data()  # 保存用户数据
+            get_user_data_manager().save_user_data(user_id)  # 保存用户数据
             await context.bot.send_message(chat_id=user_id, text=f"Switched to Conversation ID: {cid[:5]}..., code name: {conv['name']}.")
             return
 
@@ -164,48 +466,64 @@ async def switch_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def delete_current_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_chat.id
-    user_settings = user_data_manager.user_data[str(user_id)]
+    user_settings = get_user_data_manager().user_data[str(user_id)]
     current_conversation_id = user_settings.get('current_conversation')
 
     if current_conversation_id in user_settings['conversations']:
         del user_settings['conversations'][current_conversation_id]  # 删除当前对话
         user_settings['current_conversation'] = None  # 清空当前对话 ID
-        user_data_manager.save_user_data()  # 保存用户数据
+        get_user_data_manager().save_user_data(user_id, current_conversation_id)  # 保存用户数据
         await context.bot.send_message(chat_id=user_id, text="The current conversation has been deleted.")
     else:
         await context.bot.send_message(chat_id=user_id, text="Current conversation not found.")
 
-async def get_model_response(update, context, user_settings, user_id, user_message):
-    user_settings['is_processing'] = True
-    loading_message = await context.bot.send_message(chat_id=user_id, text="Responding, please wait...\nThe information sent in the response is not valid.")
+async def get_model_response(update, context, user_settings, user_id, user_message, current_conversation_id):
+    if current_conversation_id not in user_settings['conversations']:
+        await context.bot.send_message(chat_id=user_id, text="The conversation for this message has been deleted.", reply_to_message_id=update.message.message_id)
+        return
+    loading_message = await context.bot.send_message(chat_id=user_id, text="Responding, please wait...\nThe information sent in the response is not valid.", reply_to_message_id=update.message.message_id)
 
     api_key = user_settings['openai_token']
     base_url = user_settings['base_url']
-    model = user_settings.get('model', 'gpt-3.5-turbo')
-    client = OpenAI(api_key=api_key, base_url=base_url)
-
-    current_conversation_id = user_settings['current_conversation']
-    conversation_history = user_settings['conversations'][current_conversation_id]['history']
-    conversation_history.append({"role": "user", "content": user_message})
-
-    response = client.chat.completions.create(
-        model=model,
-        messages=conversation_history
-    )
-
-    bot_reply = response.choices[0].message.content
-    await context.bot.send_message(chat_id=user_id, text=bot_reply, parse_mode='Markdown', reply_to_message_id=update.message.message_id)
+    model = user_settings.get('model') or 'gpt-3.5-turbo'
+
+    # 处理期间固定对话历史，不会被换出内存
+    with get_user_data_manager().pin(user_id, current_conversation_id) as conversation_history:
+        conversation = user_settings['conversations'][current_conversation_id]
+        conversation_history.append({"role": "user", "content": user_message, "tokens": count_tokens(user_message, model) + MESSAGE_TOKEN_OVERHEAD})
+        context_messages, window_start = build_context(conversation, model)
+        if needs_summary(conversation, window_start, model):
+            asyncio.ensure_future(summarize_conversation(user_id, current_conversation_id, user_settings, window_start))
+
+        stream = ReplyStream(context.bot, user_id, loading_message.message_id) if STREAM_REPLIES else None
+        try:
+            if stream is not None:
+                async for delta in client_pool.stream_completion(base_url, api_key, model, context_messages):
+                    await stream.feed(delta)
+                bot_reply = stream.text
+            else:
+                bot_reply = await client_pool.create_completion(base_url, api_key, model, context_messages)
+        except Exception as e:
+            conversation_history.pop()  # 请求失败时不保留这条用户消息
+            if stream is not None and stream.started:
+                await context.bot.send_message(chat_id=user_id, text=f"An error occurred: {str(e)}", reply_to_message_id=update.message.message_id)
+            else:
+                await context.bot.edit_message_text(chat_id=user_id, message_id=loading_message.message_id, text=f"An error occurred: {str(e)}")
+            return
 
-    user_settings['conversations'][current_conversation_id]['history'].append({"role": "assistant", "content": bot_reply})
+        if stream is not None:
+            await stream.finish()
+        else:
+            await context.bot.send_message(chat_id=user_id, text=bot_reply, parse_mode='Markdown', reply_to_message_id=update.message.message_id)
+            await context.bot.delete_message(chat_id=user_id, message_id=loading_message.message_id)
 
-    user_settings['is_processing'] = False
-    await context.bot.delete_message(chat_id=user_id, message_id=loading_message.message_id)
-    user_data_manager.save_user_data()  # 保存用户数据
+        conversation_history.append({"role": "assistant", "content": bot_reply, "tokens": count_tokens(bot_reply, model) + MESSAGE_TOKEN_OVERHEAD})
+        get_user_data_manager().save_user_data(user_id, current_conversation_id)  # 保存用户数据
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_message = update.message.text
     user_id = update.effective_chat.id
-    user_settings = user_data_manager.user_data[str(user_id)]
+    user_settings = get_user_data_manager().user_data[str(user_id)]
 
     if not user_settings['openai_token']:
         await context.bot.send_message(chat_id=user_id, text="Please use the /set command to set the necessary parameters first.")
@@ -213,17 +531,345 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif not user_settings['current_conversation']:
         await context.bot.send_message(chat_id=user_id, text="Please create a new conversation using /new_conversation <code name> first.")
         return
-    if user_settings.get('is_processing', False):
-        await context.bot.send_message(chat_id=user_id, text="The information sent in the response is invalid.", reply_to_message_id=update.message.message_id)
+
+    async def job():
+        try:
+            await get_model_response(update, context, user_settings, user_id, user_message, conversation_id)
+        except Exception as e:
+            print(f"处理消息失败：{user_id}，错误信息：{str(e)}")
+            await context.bot.send_message(chat_id=user_id, text=f"An error occurred: {str(e)}", reply_to_message_id=update.message.message_id)
+
+    # 消息属于发送时所在的对话，排队期间切换对话不会影响它
+    conversation_id = user_settings['current_conversation']
+    ahead = scheduler.submit(user_id, job)
+    if ahead is None:
+        await context.bot.send_message(chat_id=user_id, text=f"You have {USER_QUEUE_LIMIT} messages waiting. Please wait for the replies before sending more.", reply_to_message_id=update.message.message_id)
+    elif ahead:
+        await context.bot.send_message(chat_id=user_id, text=f"Queued: {ahead} message(s) ahead of this one. Replies are sent in order.", reply_to_message_id=update.message.message_id)
+
+class ClientPool:
+    """按 (base_url, token) 复用 AsyncOpenAI 客户端，同一接口的请求共享 HTTP 长连接"""
+    def __init__(self, max_clients=CLIENT_POOL_SIZE):
+        self.max_clients = max_clients
+        self.clients = OrderedDict()  # (base_url, token) -> 客户端，按最近使用排序
+        self.active = defaultdict(int)  # (base_url, token) -> 正在进行的请求数
+
+    @staticmethod
+    def timeout_for(base_url):
+        return float(ENDPOINT_TIMEOUTS.get(urlparse(base_url or '').netloc, LLM_TIMEOUT))
+
+    def get(self, base_url, token):
+        key = (base_url, token)
+        client = self.clients.pop(key, None)
+        if client is None:
+            client = lazy_import('openai').AsyncOpenAI(api_key=token, base_url=base_url,
+                                                       timeout=self.timeout_for(base_url), max_retries=LLM_MAX_RETRIES)
+        self.clients[key] = client
+        self.evict(keep=key)
+        return client
+
+    def evict(self, keep=None):
+        """客户端数超过上限时关闭最久未使用的空闲客户端，正在使用的不会被关闭"""
+        idle = [key for key in self.clients if key != keep and not self.active[key]]
+        for key in idle[:max(len(self.clients) - self.max_clients, 0)]:
+            asyncio.ensure_future(self.clients.pop(key).close())
+            self.active.pop(key, None)
+
+    async def create_completion(self, base_url, token, model, messages):
+        """在全局并发上限内异步请求一次补全，返回回复文本"""
+        async with get_completion_semaphore():
+            key = (base_url, token)
+            client = self.get(base_url, token)
+            self.active[key] += 1
+            try:
+                response = await client.chat.completions.create(model=model, messages=messages)
+            finally:
+                self.active[key] -= 1
+        return response.choices[0].message.content
+
+    async def stream_completion(self, base_url, token, model, messages):
+        """在全局并发上限内以流式方式请求补全，逐段产出回复文本"""
+        async with get_completion_semaphore():
+            key = (base_url, token)
+            client = self.get(base_url, token)
+            self.active[key] += 1
+            try:
+                stream = await client.chat.completions.create(model=model, messages=messages, stream=True)
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            finally:
+                self.active[key] -= 1
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.close()
+        self.clients.clear()
+
+client_pool = ClientPool()
+completion_semaphore = None  # 限制全局同时进行的模型请求数
+
+def get_completion_semaphore():
+    global completion_semaphore
+    if completion_semaphore is None:
+        completion_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+    return completion_semaphore
+
+def utf16_length(text):
+    return len(text.encode('utf-16-le')) // 2
+
+def split_point(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """返回不超过 limit 的拆分位置，尽量在后半段的换行处拆分"""
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if utf16_length(text[:middle]) <= limit:
+            low = middle
+        else:
+            high = middle - 1
+    newline = text.rfind('\n', low // 2, low)
+    return newline + 1 if newline > 0 else low
+
+class ReplyStream:
+    """把流式生成的回复逐步写入消息：按 STREAM_EDIT_INTERVAL 节流编辑，超过单条消息长度时续写到新消息，
+    生成过程中以纯文本显示，结束后再按 Markdown 渲染，解析失败时保留纯文本"""
+    def __init__(self, bot, chat_id, message_id):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_ids = [message_id]
+        self.texts = ['']  # 每条消息应显示的内容
+        self.shown = [None]  # 每条消息当前实际显示的内容
+        self.next_edit = 0  # 下一次允许编辑的时间
+
+    @property
+    def text(self):
+        return ''.join(self.texts)
+
+    @property
+    def started(self):
+        return any(shown is not None for shown in self.shown)
+
+    async def feed(self, delta):
+        self.texts[-1] += delta
+        while utf16_length(self.texts[-1]) > TELEGRAM_MESSAGE_LIMIT:
+            text = self.texts[-1]
+            cut = split_point(text)
+            self.texts[-1] = text[:cut]
+            await self.edit(len(self.texts) - 1)
+            message = await self.bot.send_message(chat_id=self.chat_id, text="…")
+            self.message_ids.append(message.message_id)
+            self.texts.append(text[cut:])
+            self.shown.append(None)
+        if time.monotonic() >= self.next_edit:
+            await self.edit(len(self.texts) - 1)
+
+    async def edit(self, index):
+        """以纯文本刷新一条消息，被限流时跳过，等下一次再刷新"""
+        text = self.texts[index]
+        if not text.strip() or text == self.shown[index]:
+            return
+        try:
+            await self.bot.edit_message_text(chat_id=self.chat_id, message_id=self.message_ids[index], text=text)
+            self.shown[index] = text
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if hasattr(retry_after, 'total_seconds'):
+                retry_after = retry_after.total_seconds()
+            self.next_edit = time.monotonic() + retry_after
+            return
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                raise
+        self.next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+
+    async def finish(self):
+        """生成结束后按 Markdown 渲染每条消息，解析失败时改用纯文本"""
+        if not self.text.strip():
+            self.texts[0] = "(empty response)"
+        for index, text in enumerate(self.texts):
+            if not text.strip():
+                continue
+            for parse_mode in ('Markdown', None):
+                try:
+                    await self.finalize(index, text, parse_mode)
+                    break
+                except BadRequest as e:
+                    if 'not modified' in str(e).lower():
+                        break
+
+    async def finalize(self, index, text, parse_mode):
+        while True:
+            try:
+                await self.bot.edit_message_text(chat_id=self.chat_id, message_id=self.message_ids[index],
+                                                 text=text, parse_mode=parse_mode)
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if hasattr(retry_after, 'total_seconds'):
+                    retry_after = retry_after.total_seconds()
+                await asyncio.sleep(retry_after)
+
+token_encoders = {}  # 模型名 -> tiktoken 编码器，tiktoken 不可用时为 None
+
+def get_token_encoder(model):
+    """tiktoken 是可选依赖，未安装或无法加载编码表时使用估算"""
+    if model not in token_encoders:
+        try:
+            tiktoken = lazy_import('tiktoken')
+            try:
+                token_encoders[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                token_encoders[model] = tiktoken.get_encoding('cl100k_base')
+        except Exception:
+            token_encoders[model] = None
+    return token_encoders[model]
+
+def count_tokens(text, model=None):
+    encoder = get_token_encoder(model)
+    if encoder is not None:
+        return len(encoder.encode(text))
+    # 估算：中日韩字符约 1 个 token，其余约 4 个字符 1 个 token
+    wide = sum(1 for char in text if ord(char) > 0x2E80)
+    return wide + (len(text) - wide + 3) // 4
+
+def message_tokens(message, model=None):
+    """返回消息的 token 数，结果缓存在消息的 tokens 字段中，随对话历史一起保存"""
+    if 'tokens' not in message:
+        message['tokens'] = count_tokens(message['content'], model) + MESSAGE_TOKEN_OVERHEAD
+    return message['tokens']
+
+def build_context(conversation, model=None, budget=CONTEXT_TOKEN_BUDGET):
+    """从最新的消息往前取，在 token 预算内组成请求上下文，更早的消息以滚动摘要代替
+
+    返回 (发送给模型的消息列表, 窗口起始位置)。消息中缓存的 tokens 等字段不会发送，完整历史仍保留在存储中。
+    """
+    history = conversation['history']
+    summary = conversation.get('summary')
+    start = fit_window(history, model, budget)
+    if summary and start > 0:
+        # 只有放不下全部历史、需要发送摘要时才为摘要预留预算
+        start = fit_window(history, model, budget - count_tokens(summary, model) - MESSAGE_TOKEN_OVERHEAD)
+
+    messages = [{'role': message['role'], 'content': message['content']} for message in history[start:]]
+    if summary and start > 0:
+        messages.insert(0, {'role': 'system', 'content': f"Summary of the earlier conversation:\n{summary}"})
+    return messages, start
+
+def fit_window(history, model, budget):
+    """从最新的消息往前累计 token，返回预算内能放下的最早位置；最新一条消息总会保留"""
+    start, used = len(history), 0
+    while start > 0:
+        tokens = message_tokens(history[start - 1], model)
+        if used + tokens > budget and start < len(history):
+            break
+        used += tokens
+        start -= 1
+    return start
+
+def needs_summary(conversation, start, model):
+    """窗口之前未摘要的部分积累到一定量才更新摘要，避免窗口每轮滑动一两条消息都额外调用一次模型"""
+    history = conversation['history']
+    pending = history[conversation.get('summary_upto', 0):start]
+    return len(pending) >= SUMMARY_TRIGGER_MESSAGES or \
+        sum(message_tokens(message, model) for message in pending) >= SUMMARY_TRIGGER_TOKENS
+
+summarizing = set()  # 正在生成摘要的 (用户 ID, 对话 ID)
+
+async def summarize_conversation(user_id, conversation_id, user_settings, end):
+    """在后台把窗口之前尚未摘要的消息并入滚动摘要，失败时下次再试"""
+    key = (str(user_id), conversation_id)
+    conversation = user_settings['conversations'].get(conversation_id)
+    if key in summarizing or conversation is None:
         return
+    summarizing.add(key)
     try:
-        asyncio.create_task(get_model_response(update, context, user_settings, user_id, user_message))
+        covered = conversation.get('summary_upto', 0)
+        with get_user_data_manager().pin(user_id, conversation_id) as history:
+            transcript = "\n".join(f"{message['role']}: {message['content']}" for message in history[covered:end])
+        prompt = (
+            f"Update the summary of a conversation in at most {SUMMARY_TOKEN_BUDGET} tokens. "
+            "Keep facts, decisions, names and open questions; write in the language of the conversation.\n\n"
+            f"Current summary:\n{conversation.get('summary') or '(none)'}\n\nNew messages:\n{transcript}"
+        )
+        summary = await client_pool.create_completion(
+            user_settings['base_url'], user_settings['openai_token'], user_settings.get('model') or 'gpt-3.5-turbo',
+            [{'role': 'user', 'content': prompt}])
+        if conversation_id in user_settings['conversations'] and summary:
+            conversation['summary'] = summary
+            conversation['summary_upto'] = end
+            get_user_data_manager().save_user_data(user_id, conversation_id)
     except Exception as e:
-        await context.bot.send_message(chat_id=user_id, text=f"An error occurred: {str(e)}")
+        print(f"生成对话摘要失败：{str(e)}")
+    finally:
+        summarizing.discard(key)
+
+class RequestScheduler:
+    """每个用户一个先进先出队列，同一用户的消息按顺序逐条处理，不同用户之间并行
+
+    全局并发由 get_completion_semaphore() 限制，其等待者按先来先得唤醒；每个用户同时只占一个名额，
+    连续发送大量消息的用户不会挤占其他用户。任务出错或被取消时都会清理队列状态。
+    """
+    def __init__(self, limit=USER_QUEUE_LIMIT):
+        self.limit = limit
+        self.queues = {}  # 用户 ID -> 等待处理的任务
+        self.workers = {}  # 用户 ID -> 正在处理该用户队列的任务
+        self.running = set()  # 正在处理某条消息的用户
+
+    def pending(self, user_id):
+        """该用户尚未完成的消息数（包括正在处理的一条）"""
+        return len(self.queues.get(user_id, ())) + (user_id in self.running)
+
+    def submit(self, user_id, job):
+        """加入队列，返回前面还有几条消息；队列已满时返回 None"""
+        queue = self.queues.setdefault(user_id, deque())
+        if len(queue) >= self.limit:
+            return None
+        ahead = self.pending(user_id)
+        queue.append(job)
+        if user_id not in self.workers:
+            self.workers[user_id] = asyncio.ensure_future(self.work(user_id))
+        return ahead
+
+    async def work(self, user_id):
+        queue = self.queues[user_id]
+        try:
+            while queue:
+                job = queue.popleft()
+                self.running.add(user_id)
+                try:
+                    await job()
+                except Exception as e:
+                    print(f"队列任务失败：{user_id}，错误信息：{str(e)}")
+                finally:
+                    self.running.discard(user_id)
+        finally:
+            self.workers.pop(user_id, None)
+            if not queue:
+                self.queues.pop(user_id, None)
+
+scheduler = RequestScheduler()
+
+storage_task = None  # 用户数据的后台写回任务
+
+async def start_storage(application):
+    async def run():
+        manager = await asyncio.get_event_loop().run_in_executor(None, get_user_data_manager)
+        await manager.run_background()
+
+    global storage_task
+    storage_task = asyncio.ensure_future(run())
+
+async def shutdown(application):
+    """退出前写回剩余的修改、做最后一次 git 同步，并关闭模型客户端的连接"""
+    if storage_task is not None:
+        storage_task.cancel()
+    if user_data_manager is not None:
+        await user_data_manager.close()
+    await client_pool.close()
 
 def main():
     TOKEN = os.environ['BOT_TOKEN']
-    application = ApplicationBuilder().token(TOKEN).build()
+    application = ApplicationBuilder().token(TOKEN).post_init(start_storage).post_shutdown(shutdown).build()
     application.add_handler(CommandHandler('start', start))
     application.add_handler(CommandHandler('help', help_command))
     application.add_handler(CommandHandler('set', set_parameters))
@@ -233,7 +879,11 @@ def main():
     application.add_handler(CommandHandler('delete_current_conversation', delete_current_conversation))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
+    if PREWARM:
+        Thread(target=prewarm, name="prewarm", daemon=True).start()
     application.run_polling()
 
+MODULE_LOADED = time.perf_counter()
+
 if __name__ == '__main__':
     main()
\ No newline at end of file